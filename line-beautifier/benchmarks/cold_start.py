@@ -0,0 +1,64 @@
+"""Benchmarks the cold start of `optimize.py`, i.e. a new interpreter for
+each run as in a job queue.
+
+Measures `optimize.py --help` and, if given, a small job (best with a local
+extract, so that no request is sent) and fails if the fastest run exceeds
+its budget. The heavy packages are only imported once a stage needs them,
+see `--import-report` of `optimize.py` for which ones a job loads.
+
+Run from the package directory:
+`python -m benchmarks.cold_start --input small.geojson --extract region.osm`
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+
+def run(args, runs):
+    """Returns the seconds of each of `runs` runs of `optimize.py args`."""
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, 'optimize.py'] + args, check=True,
+                       stdout=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i', required=False, type=str,
+                        default=None,
+                        help='small input file to optimize')
+    parser.add_argument('--extract', '-e', required=False, type=str,
+                        default=None,
+                        help='local OSM extract for the small job')
+    parser.add_argument('--runs', '-r', required=False, type=int,
+                        default=5,
+                        help='runs per command')
+    parser.add_argument('--help-budget', required=False, type=float,
+                        default=.3,
+                        help='budget in seconds for --help')
+    parser.add_argument('--budget', '-b', required=False, type=float,
+                        default=3.,
+                        help='budget in seconds for the small job')
+    args = parser.parse_args()
+    commands = [('--help', ['--help'], args.help_budget)]
+    if args.input:
+        output = os.path.join(tempfile.mkdtemp(), 'output.geojson')
+        job = ['-i', args.input, '-o', output, '-S', '-NC']
+        if args.extract:
+            job += ['-e', args.extract]
+        commands.append(('small job', job, args.budget))
+    exceeded = False
+    for name, command, budget in commands:
+        seconds = run(command, args.runs)
+        ok = min(seconds) <= budget
+        exceeded |= not ok
+        print('%-10s min %6.3fs  median %6.3fs  budget %6.3fs  %s'
+              % (name, min(seconds), sorted(seconds)[len(seconds) // 2],
+                 budget, 'ok' if ok else 'EXCEEDED'))
+    sys.exit(1 if exceeded else 0)
@@ -0,0 +1,80 @@
+"""Benchmarks `osm.query_overpass.query_overpass` against local Overpass emulators.
+
+Measures fetching without cache, into a cold cache and from a warm cache,
+with the injections of `benchmarks.overpass_server` (latency, bandwidth,
+errors, timeouts), optionally across several mirrors.
+
+Run from the package directory: `python -m benchmarks.fetch fixture.json`
+"""
+import time
+import shutil
+import argparse
+import tempfile
+
+from osm.query_overpass import query_overpass, DEFAULT_WORKERS
+from osm.tiles import DEFAULT_TILE_SIZE
+from osm.endpoints import DEFAULT_HEDGE_AFTER
+from benchmarks.overpass_server import Network, serve, add_arguments, injections
+
+
+def run(bounds, endpoints, servers, cache, **kwargs):
+    """Returns the seconds and the requests answered by `servers`."""
+    before = sum(s.RequestHandlerClass.stats['requests'] for s in servers)
+    start = time.time()
+    query_overpass(bounds, cache=cache, endpoint=endpoints, **kwargs)
+    elapsed = time.time() - start
+    after = sum(s.RequestHandlerClass.stats['requests'] for s in servers)
+    return elapsed, after - before
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fixture',
+                        help='OSM data (Overpass JSON, OSM XML or PBF)')
+    parser.add_argument('--bounds', required=False, type=float, nargs=4,
+                        default=None,
+                        help='minx miny maxx maxy, the extent of the fixture by default')
+    parser.add_argument('--tile-size', required=False, type=float,
+                        default=DEFAULT_TILE_SIZE,
+                        help='tile size in degrees')
+    parser.add_argument('--workers', '-w', required=False, type=int,
+                        default=DEFAULT_WORKERS,
+                        help='concurrent requests')
+    parser.add_argument('--mirrors', '-m', required=False, type=int,
+                        default=1,
+                        help='number of emulated mirrors')
+    parser.add_argument('--hedge-after', required=False, type=float,
+                        default=DEFAULT_HEDGE_AFTER,
+                        help='seconds until a request is hedged by the next mirror')
+    parser.add_argument('--timeout', required=False, type=float,
+                        default=5.,
+                        help='request timeout (seconds)')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    network = Network(args.fixture)
+    bounds = tuple(args.bounds) if args.bounds else \
+             (network.lon.min(), network.lat.min(), network.lon.max(), network.lat.max())
+    servers, endpoints = [], []
+    for i in range(args.mirrors):
+        kwargs = injections(args)
+        kwargs['seed'] += i
+        server, endpoint = serve(network, **kwargs)
+        servers.append(server)
+        endpoints.append(endpoint)
+    kwargs = dict(tile_size=args.tile_size, workers=args.workers,
+                  timeout=args.timeout, hedge_after=args.hedge_after)
+    cache = tempfile.mkdtemp()
+    try:
+        for name, path in [('no cache', None), ('cold cache', cache), ('warm cache', cache)]:
+            elapsed, requests = run(bounds, endpoints, servers, path, **kwargs)
+            print('%-10s: %8.3fs %5d requests' % (name, elapsed, requests))
+    finally:
+        shutil.rmtree(cache)
+        for server in servers:
+            server.shutdown()
+    for i, server in enumerate(servers):
+        stats = server.RequestHandlerClass.stats
+        print('mirror %d: %d requests, status %s, %.1f MB, max. %d concurrent'
+              % (i, stats['requests'], stats['status'], stats['bytes'] / 1e6,
+                 stats['max_active']))
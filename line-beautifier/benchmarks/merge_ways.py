@@ -0,0 +1,66 @@
+"""Benchmarks `osm.convert.merge_ways` on long, heavily split roads.
+
+Run from the package directory: `python -m benchmarks.merge_ways`
+"""
+import time
+import random
+import argparse
+from collections import defaultdict
+
+from osm.convert import merge_ways
+
+
+def split_roads(roads, splits, nodes_per_way=3, shuffle=False, seed=0):
+    """Creates `roads` straight roads, each broken up into `splits` OSM ways.
+      The ways of a road are listed from its end to its start, which makes
+      every merge extend the front of the road. If `shuffle` is True, ways
+      are randomly reversed and listed in random order instead.
+    """
+    rnd = random.Random(seed)
+    ways, expected = [], []
+    node_id, way_id = 0, 0
+    for _ in range(roads):
+        nodes = list(range(node_id, node_id + splits * nodes_per_way + 1))
+        node_id += len(nodes)
+        expected.append(nodes)
+        for i in reversed(range(splits)):
+            way_nodes = nodes[i * nodes_per_way:(i + 1) * nodes_per_way + 1]
+            if shuffle and rnd.random() < 0.5:
+                way_nodes = way_nodes[::-1]
+            ways.append({'id': way_id, 'nodes': way_nodes})
+            way_id += 1
+    if shuffle:
+        rnd.shuffle(ways)
+    return ways, expected
+
+
+def run(roads, splits, shuffle=False):
+    ways, expected = split_roads(roads, splits, shuffle=shuffle)
+    node_count = defaultdict(list)
+    for w in ways:
+        for n in w['nodes']:
+            node_count[n].append(w['id'])
+    ways = {w['id']: w for w in ways}
+    start = time.time()
+    merged, _ = merge_ways(ways, node_count)
+    elapsed = time.time() - start
+    result = sorted(min(w['nodes'], w['nodes'][::-1]) for w in merged.values())
+    if result != sorted(expected):
+        raise AssertionError('Roads were not merged correctly.')
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--roads', '-r', required=False, type=int,
+                        default=20,
+                        help='number of roads')
+    parser.add_argument('--splits', '-s', required=False, type=int,
+                        nargs='+', default=[200, 400, 800, 1600],
+                        help='number of OSM ways per road')
+    parser.add_argument('--shuffle', required=False, action='store_true',
+                        help='reverse and shuffle ways randomly')
+    args = parser.parse_args()
+    for splits in args.splits:
+        elapsed = run(args.roads, splits, args.shuffle)
+        print('%5d roads x %5d ways: %8.3fs' % (args.roads, splits, elapsed))
@@ -0,0 +1,236 @@
+"""Local stand-in for the Overpass API, for benchmarks without network access.
+
+Answers the queries of `osm.query_overpass.build_query` from a local fixture
+(Overpass JSON, optionally gzip compressed) or OSM extract (XML or PBF), with
+configurable latency, bandwidth, error and timeout injection.
+
+Run from the package directory:
+  `python -m benchmarks.overpass_server fixture.json --port 8080 --latency 0.5`
+and query it with `query_overpass(..., endpoint='http://127.0.0.1:8080/api/interpreter')`.
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from osm.convert import iter_elements
+from osm.extract import iter_extract
+from osm.query_overpass import is_road
+
+
+CHUNK_SIZE = 1 << 16
+ERROR_STATUS = (429, 503, 504)
+_BOUNDS = re.compile(r'node\(([-0-9.e]+),([-0-9.e]+),([-0-9.e]+),([-0-9.e]+)\)')
+
+
+class Network(object):
+    """The nodes and streets of a fixture, indexed for bounding box queries."""
+    def __init__(self, path):
+        if path.endswith('.json') or path.endswith('.json.gz'):
+            elements = iter_elements(path)
+        else:
+            elements = iter_extract(path)
+        nodes, ways = {}, []
+        for obj in elements:
+            if obj['type'] == 'node':
+                nodes[obj['id']] = obj
+            elif obj['type'] == 'way' and is_road(obj.get('tags', {'highway': ''})):
+                ways.append(obj)
+        ids = sorted(nodes)
+        self.lon = np.array([nodes[i]['lon'] for i in ids])
+        self.lat = np.array([nodes[i]['lat'] for i in ids])
+        # elements are serialized once, responses only join them
+        self.nodes = [json.dumps(nodes[i]).encode() for i in ids]
+        self.ways = [json.dumps(w).encode() for w in ways]
+        way_nodes = [n for w in ways for n in w['nodes']]
+        self.way_nodes = np.searchsorted(ids, way_nodes).astype(int)
+        self.way_lengths = np.array([len(w['nodes']) for w in ways], dtype=int)
+        self.way_starts = np.cumsum(self.way_lengths) - self.way_lengths
+
+    def query(self, bounds):
+        """Returns the response of Overpass to `build_query(bounds)` as bytes:
+          all nodes within `bounds`, all streets with a node within `bounds`
+          and all nodes of those streets.
+        """
+        minx, miny, maxx, maxy = bounds
+        inside = (self.lon >= minx) & (self.lon <= maxx) & \
+                 (self.lat >= miny) & (self.lat <= maxy)
+        hit = np.zeros(len(self.ways), bool)
+        if len(self.way_nodes):
+            hit = np.add.reduceat(inside[self.way_nodes], self.way_starts) > 0
+        selected = inside.copy()
+        selected[self.way_nodes[np.repeat(hit, self.way_lengths)]] = True
+        elements = [self.nodes[i] for i in np.flatnonzero(selected)] + \
+                   [self.ways[i] for i in np.flatnonzero(hit)]
+        return b'{"version": 0.6, "generator": "overpass_server", "elements": [\n' + \
+               b',\n'.join(elements) + b'\n]}\n'
+
+
+def parse_bounds(query):
+    """Returns the bounds (minx, miny, maxx, maxy) of a `build_query` query."""
+    if not query.startswith('[out:json]'):
+        raise ValueError('Only [out:json] queries are supported.')
+    match = _BOUNDS.search(query)
+    if match is None:
+        raise ValueError('The query contains no bounding box.')
+    y1, x1, y2, x2 = map(float, match.groups())
+    return (x1, y1, x2, y2)
+
+
+def make_handler(network, latency=0., jitter=0., bandwidth=None,
+                 error_rate=0., error_status=ERROR_STATUS, retry_after=None,
+                 timeout_rate=0., hang=30., max_area=None, seed=0):
+    """Returns a request handler class serving `network`.
+      Arguments:
+        latency: Float. Seconds before a response is sent.
+        jitter: Float. Random extra latency, up to this many seconds.
+        bandwidth: Float or None. Bytes per second at which responses are sent.
+        error_rate: Float. Fraction of requests answered by one of
+          `error_status` (with a `Retry-After` header if `retry_after` is set).
+        timeout_rate: Float. Fraction of requests which are not answered for
+          `hang` seconds, after which the connection is dropped.
+        max_area: Float or None. Queries covering more square degrees are
+          aborted like Overpass does: status 200 with a runtime error remark.
+        seed: Int. Seed of the random injections, for reproducible runs.
+      Returns:
+        Class. The handler, with a `stats` Dict counting requests, status codes,
+          bytes sent and the maximum number of concurrent requests.
+    """
+    rnd = random.Random(seed)
+    lock = threading.Lock()
+    stats = {'requests': 0, 'status': {}, 'bytes': 0, 'active': 0, 'max_active': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, status, body, headers=()):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in headers:
+                self.send_header(key, value)
+            self.end_headers()
+            for i in range(0, len(body), CHUNK_SIZE):
+                chunk = body[i:i + CHUNK_SIZE]
+                self.wfile.write(chunk)
+                if bandwidth:
+                    time.sleep(len(chunk) / float(bandwidth))
+            with lock:
+                stats['status'][status] = stats['status'].get(status, 0) + 1
+                stats['bytes'] += len(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with lock:
+                stats['requests'] += 1
+                stats['active'] += 1
+                stats['max_active'] = max(stats['max_active'], stats['active'])
+                draw, delay = rnd.random(), latency + rnd.uniform(0, jitter)
+                status = rnd.choice(error_status)
+            try:
+                time.sleep(delay)
+                if draw < timeout_rate:
+                    time.sleep(hang)
+                    self.close_connection = True
+                    return
+                if draw < timeout_rate + error_rate:
+                    headers = [('Retry-After', str(retry_after))] if retry_after else []
+                    self.send(status, b'', headers)
+                    return
+                try:
+                    bounds = parse_bounds(parse_qs(body.decode())['data'][0])
+                except (KeyError, ValueError) as err:
+                    self.send(400, str(err).encode())
+                    return
+                area = (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+                if max_area is not None and area > max_area:
+                    self.send(200, b'{"version": 0.6, "elements": [], "remark": '
+                                   b'"runtime error: Query timed out."}\n')
+                    return
+                self.send(200, network.query(bounds))
+            finally:
+                with lock:
+                    stats['active'] -= 1
+
+    Handler.stats = stats
+    return Handler
+
+
+def serve(fixture, host='127.0.0.1', port=0, **kwargs):
+    """Starts the emulator in a background thread.
+      Arguments:
+        fixture: String or Network. The OSM data to serve.
+        kwargs: The injections, see `make_handler`.
+      Returns:
+        Tuple. (server, endpoint URL). Stop the server with `server.shutdown()`,
+          its statistics are in `server.RequestHandlerClass.stats`.
+    """
+    network = fixture if isinstance(fixture, Network) else Network(fixture)
+    server = ThreadingHTTPServer((host, port), make_handler(network, **kwargs))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://%s:%d/api/interpreter' % (host, server.server_port)
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', '-l', required=False, type=float,
+                        default=0.,
+                        help='seconds before each response')
+    parser.add_argument('--jitter', '-j', required=False, type=float,
+                        default=0.,
+                        help='random extra latency (seconds)')
+    parser.add_argument('--bandwidth', '-b', required=False, type=float,
+                        default=None,
+                        help='bytes per second per response')
+    parser.add_argument('--error-rate', '-e', required=False, type=float,
+                        default=0.,
+                        help='fraction of requests answered with an error status')
+    parser.add_argument('--retry-after', required=False, type=int,
+                        default=None,
+                        help='Retry-After header of error responses (seconds)')
+    parser.add_argument('--timeout-rate', '-t', required=False, type=float,
+                        default=0.,
+                        help='fraction of requests which are never answered')
+    parser.add_argument('--max-area', '-a', required=False, type=float,
+                        default=None,
+                        help='abort queries larger than this (square degrees)')
+    parser.add_argument('--seed', required=False, type=int,
+                        default=0,
+                        help='seed of the random injections')
+
+
+def injections(args):
+    """Returns the keyword arguments of `make_handler` from parsed arguments."""
+    return dict(latency=args.latency, jitter=args.jitter,
+                bandwidth=args.bandwidth, error_rate=args.error_rate,
+                retry_after=args.retry_after, timeout_rate=args.timeout_rate,
+                max_area=args.max_area, seed=args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fixture',
+                        help='OSM data (Overpass JSON, OSM XML or PBF)')
+    parser.add_argument('--host', required=False, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', '-p', required=False, type=int,
+                        default=8080,
+                        help='port to listen on')
+    add_arguments(parser)
+    args = parser.parse_args()
+    server, endpoint = serve(args.fixture, args.host, args.port, **injections(args))
+    print('Serving %s at %s' % (args.fixture, endpoint))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,240 @@
+import os
+import json
+
+from .geojson import (read_geojson, read_batches, read_seq_batches,
+                      write_geojson, write_geojsonseq, DEFAULT_BATCH_SIZE, WGS84)
+from pipeline.imports import lazy_import
+shapely = lazy_import('shapely')
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+
+
+GEOJSON = 'geojson'
+GEOJSONSEQ = 'geojsonseq'
+PARQUET = 'parquet'
+FLATGEOBUF = 'flatgeobuf'
+FORMATS = (GEOJSON, GEOJSONSEQ, PARQUET, FLATGEOBUF)
+# File extensions (also with `.gz` for GeoJSON and GeoJSONSeq) per format,
+# the first one is used for new files
+EXTENSIONS = {GEOJSON: ('.geojson', '.json'),
+              GEOJSONSEQ: ('.geojsonl', '.geojsons', '.geojsonseq', '.ndjson'),
+              PARQUET: ('.parquet', '.geoparquet'),
+              FLATGEOBUF: ('.fgb',)}
+
+
+def detect_format(path, format=None, default=None):
+    """Returns `format` or, if None, the format of `path` by its extension.
+      Unknown extensions give `default` or, if it is None, raise a ValueError.
+    """
+    if format:
+        if format not in FORMATS:
+            raise ValueError('Unknown format "%s", expected one of %s.'
+                             % (format, ', '.join(FORMATS)))
+        return format
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    for format, extensions in EXTENSIONS.items():
+        if name.endswith(extensions):
+            return format
+    if default:
+        return default
+    raise ValueError('Cannot tell the format of "%s" by its extension, '
+                     'expected one of %s.' % (path, ', '.join(
+                         e for f in FORMATS for e in EXTENSIONS[f])))
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Reading and writing GeoParquet requires the '
+                          'package `pyarrow`.')
+    return pyarrow
+
+
+def _parquet_geometry(schema):
+    """Returns the name and CRS of the primary geometry column of a
+      GeoParquet file with schema `schema`.
+    """
+    metadata = json.loads((schema.metadata or {}).get(b'geo', b'{}'))
+    if 'primary_column' not in metadata:
+        raise ValueError('The Parquet file has no GeoParquet metadata.')
+    name = metadata['primary_column']
+    column = metadata['columns'][name]
+    if column.get('encoding', 'WKB').upper() != 'WKB':
+        raise ValueError('Only WKB encoded GeoParquet geometries are supported.')
+    # GeoParquet defaults to longitude/latitude on WGS84
+    return name, column.get('crs') or WGS84
+
+
+def from_arrow(table, geometry='geometry', crs=WGS84, columns=None):
+    """Converts an Arrow table, record batch or any object exporting an Arrow
+      stream with WKB encoded geometries in column `geometry` to a
+      GeoDataFrame. Only the other `columns` (all if None) are converted.
+    """
+    pa = _import_pyarrow()
+    if not isinstance(table, (pa.Table, pa.RecordBatch)):
+        table = pa.table(table)
+    names = table.schema.names
+    if geometry not in names:
+        raise ValueError('Arrow table is expected to have column "%s".'
+                         % geometry)
+    names = [n for n in names
+             if n != geometry and (columns is None or n in columns)]
+    if names:
+        df = table.select(names).to_pandas()
+    else:
+        df = pd.DataFrame(index=pd.RangeIndex(table.num_rows))
+    wkb = table.column(geometry).to_numpy(zero_copy_only=False)
+    return gpd.GeoDataFrame(df, geometry=gpd.GeoSeries(shapely.from_wkb(wkb),
+                                                       crs=crs,
+                                                       index=df.index))
+
+
+def to_arrow(df):
+    """Converts a GeoDataFrame to an Arrow table with WKB encoded geometries
+      (in the column of the same name). The columns are converted one by
+      one, without an intermediate DataFrame.
+    """
+    pa = _import_pyarrow()
+    name = df.geometry.name
+    arrays = [pa.array(shapely.to_wkb(df.geometry.values), type=pa.binary())
+              if column == name else pa.array(df[column], from_pandas=True)
+              for column in df.columns]
+    return pa.Table.from_arrays(arrays, names=list(df.columns))
+
+
+def _read_parquet_batches(path, batch_size):
+    pa = _import_pyarrow()
+    parquet = pa.parquet.ParquetFile(path)
+    name, crs = _parquet_geometry(parquet.schema_arrow)
+    offset = 0
+    for batch in parquet.iter_batches(batch_size=batch_size):
+        df = from_arrow(batch, name, crs)
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        offset += len(df)
+        yield df
+    if offset == 0:
+        yield gpd.GeoDataFrame({'geometry': gpd.GeoSeries([], crs=crs)})
+
+
+def _read_file_batches(path, batch_size):
+    offset = 0
+    while True:
+        df = gpd.read_file(path, rows=slice(offset, offset + batch_size))
+        if len(df) == 0 and offset > 0:
+            return
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        offset += len(df)
+        yield df
+        if len(df) < batch_size:
+            return
+
+
+def _read_format(path, format):
+    """Returns the format of `path` (see `detect_format`), or None if its
+      extension is unknown.
+    """
+    try:
+        return detect_format(path, format)
+    except ValueError:
+        if format:
+            raise
+        return None
+
+
+def iter_batches(path, batch_size=DEFAULT_BATCH_SIZE, format=None):
+    """Reads geometries as GeoDataFrames of up to `batch_size` features, the
+      index continues from batch to batch.
+      Arguments:
+        path: String. A GeoJSON, GeoJSONSeq, GeoParquet or FlatGeobuf file.
+        format: String or None. One of `FORMATS`, by default the format is
+          told by the file extension (see `EXTENSIONS`). Files with another
+          extension are read by `geopandas.read_file`.
+    """
+    format = _read_format(path, format)
+    if format == GEOJSON:
+        return read_batches(path, batch_size)
+    if format == GEOJSONSEQ:
+        return read_seq_batches(path, batch_size)
+    if format == PARQUET:
+        return _read_parquet_batches(path, batch_size)
+    return _read_file_batches(path, batch_size)
+
+
+def read_geolocations(path, format=None):
+    """Reads all geometries of a file (see `iter_batches`) into a single
+      GeoDataFrame.
+    """
+    format = _read_format(path, format)
+    if format == GEOJSON:
+        return read_geojson(path)
+    if format == PARQUET:
+        _import_pyarrow()
+        return gpd.read_parquet(path)
+    if format in (FLATGEOBUF, None):
+        return gpd.read_file(path)
+    return pd.concat(list(iter_batches(path, format=format)))
+
+
+def _write_parquet(frames, path):
+    """Writes GeoDataFrames to a GeoParquet file, one row group per frame."""
+    pa = _import_pyarrow()
+    writer = None
+    try:
+        for df in frames:
+            table = to_arrow(df)
+            if writer is None:
+                column = {'encoding': 'WKB', 'geometry_types': []}
+                if df.crs is not None:
+                    column['crs'] = df.crs.to_json_dict()
+                geo = {'version': '1.0.0',
+                       'primary_column': df.geometry.name,
+                       'columns': {df.geometry.name: column}}
+                schema = table.schema.with_metadata(
+                    dict(table.schema.metadata or {}, geo=json.dumps(geo)))
+                writer = pa.parquet.ParquetWriter(path + '.part', schema)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        raise ValueError('No GeoDataFrame to write.')
+    os.replace(path + '.part', path)
+
+
+def _write_flatgeobuf(frames, path):
+    """Writes GeoDataFrames to a FlatGeobuf file. Its spatial index needs
+      all features, so the frames are combined before writing (appending
+      makes GDAL rewrite the file for each frame); the features are stored
+      in the order of the index. Unlike the other formats, the output is
+      thus held in memory as a whole.
+    """
+    df = pd.concat(list(frames), ignore_index=True)
+    # GDAL writes a directory of layers unless the name ends with `.fgb`
+    part = path + '.part.fgb'
+    df.to_file(part, driver='FlatGeobuf')
+    os.replace(part, path)
+
+
+def write_geolocations(frames, path, format=None):
+    """Writes GeoDataFrames to a single file at `path`. GeoJSON, GeoJSONSeq
+      and GeoParquet are written frame by frame, as `frames` produces them.
+      FlatGeobuf is written once all frames are produced.
+      Arguments:
+        frames: Iterable. GeoDataFrames with the same columns.
+        format: String or None. One of `FORMATS`, by default the format is
+          told by the file extension (see `EXTENSIONS`), GeoJSON if the
+          extension is unknown.
+    """
+    format = detect_format(path, format, default=GEOJSON)
+    if format == GEOJSON:
+        write_geojson(frames, path)
+    elif format == GEOJSONSEQ:
+        write_geojsonseq(frames, path)
+    elif format == PARQUET:
+        _write_parquet(frames, path)
+    else:
+        _write_flatgeobuf(frames, path)
@@ -0,0 +1,144 @@
+import os
+import gzip
+import json
+
+from osm.convert import stream_array
+from pipeline.imports import lazy_import
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+
+
+# Features per GeoDataFrame when reading in batches
+DEFAULT_BATCH_SIZE = 10000
+WGS84 = 'EPSG:4326'
+GEOMETRY_TYPES = ('Point', 'MultiPoint', 'LineString', 'MultiLineString',
+                  'Polygon', 'MultiPolygon', 'GeometryCollection')
+
+
+def _open(path, mode, compressed=None):
+    """Opens a text file, gzip compressed if `path` ends with `.gz` (or if
+      `compressed` is True).
+    """
+    if compressed is None:
+        compressed = path.endswith('.gz')
+    opener = gzip.open if compressed else open
+    return opener(path, mode + 't', encoding='utf-8')
+
+
+def _crs(members):
+    """Returns the CRS of a legacy GeoJSON `crs` member, WGS84 by default."""
+    try:
+        return members['crs']['properties']['name']
+    except (KeyError, TypeError):
+        return WGS84
+
+
+def iter_features(path, members=None):
+    """Yields the features of a GeoJSON FeatureCollection one at a time,
+      the file is read incrementally (see `osm.convert.stream_array`).
+      A file holding a single Feature or geometry yields it as one feature.
+    """
+    members = {} if members is None else members
+    with _open(path, 'r') as fp:
+        for feature in stream_array(fp, 'features', members):
+            yield feature
+    # any other object was read into `members` as a whole
+    type = members.get('type')
+    if type == 'Feature':
+        yield dict(members)
+    elif type in GEOMETRY_TYPES:
+        yield {'type': 'Feature', 'properties': {}, 'geometry': dict(members)}
+    elif type != 'FeatureCollection':
+        raise ValueError('Expected a GeoJSON FeatureCollection, Feature or '
+                         'geometry in "%s".' % path)
+
+
+def _to_frame(features, offset, crs):
+    """Returns `features` as GeoDataFrame, indexed from `offset` on."""
+    df = gpd.GeoDataFrame.from_features(features, crs=crs)
+    if 'geometry' not in df.columns:
+        df = gpd.GeoDataFrame(df, geometry=gpd.GeoSeries([], crs=crs))
+    df.index = pd.RangeIndex(offset, offset + len(df))
+    return df
+
+
+def read_batches(path, batch_size=DEFAULT_BATCH_SIZE):
+    """Reads a GeoJSON file as GeoDataFrames of up to `batch_size` features.
+      Only one batch of features is held in memory at a time. The index
+      continues from batch to batch, as if the file was read at once.
+      A `crs` member is only honoured if it precedes the features.
+    """
+    members, batch, offset = {}, [], 0
+    for feature in iter_features(path, members):
+        batch.append(feature)
+        if len(batch) == batch_size:
+            yield _to_frame(batch, offset, _crs(members))
+            offset += len(batch)
+            batch = []
+    if batch or offset == 0:
+        yield _to_frame(batch, offset, _crs(members))
+
+
+def read_seq_batches(path, batch_size=DEFAULT_BATCH_SIZE):
+    """Reads a GeoJSONSeq file (one feature per line, optionally prefixed by
+      a record separator) as GeoDataFrames of up to `batch_size` features.
+    """
+    batch, offset = [], 0
+    with _open(path, 'r') as fp:
+        for line in fp:
+            line = line.strip('\x1e \t\r\n')
+            if not line:
+                continue
+            batch.append(json.loads(line))
+            if len(batch) == batch_size:
+                yield _to_frame(batch, offset, WGS84)
+                offset += len(batch)
+                batch = []
+    if batch or offset == 0:
+        yield _to_frame(batch, offset, WGS84)
+
+
+def read_geojson(path):
+    """Reads a GeoJSON file into a single GeoDataFrame."""
+    return pd.concat(list(read_batches(path)))
+
+
+def write_geojson(frames, path):
+    """Writes GeoDataFrames to a GeoJSON FeatureCollection at `path`, one
+      feature at a time, so `frames` can be a generator producing them while
+      they are written. Feature ids are numbered across all frames. The file
+      is gzip compressed if `path` ends with `.gz`.
+    """
+    count, crs = 0, None
+    with _open(path + '.part', 'w', path.endswith('.gz')) as fp:
+        fp.write('{"type": "FeatureCollection", "features": [')
+        for df in frames:
+            crs = crs or df.crs
+            df = df.set_axis(pd.RangeIndex(count, count + len(df)))
+            for feature in df.iterfeatures(na='null'):
+                fp.write((', ' if count else '') + json.dumps(feature))
+                count += 1
+        fp.write(']')
+        # like `GeoDataFrame.to_json`, the CRS is only stated if not WGS84
+        authority = crs.to_authority() if crs is not None and \
+                    not crs.equals(WGS84) else None
+        if authority is not None:
+            fp.write(', "crs": ' + json.dumps({'type': 'name', 'properties': {
+                'name': 'urn:ogc:def:crs:%s::%s' % authority}}))
+        fp.write('}')
+    # an interrupted write must not leave a truncated file behind
+    os.replace(path + '.part', path)
+
+
+def write_geojsonseq(frames, path):
+    """Writes GeoDataFrames to a GeoJSONSeq file at `path`, one feature per
+      line, as they are produced by `frames` (see `write_geojson`).
+    """
+    count = 0
+    with _open(path + '.part', 'w', path.endswith('.gz')) as fp:
+        for df in frames:
+            df = df.set_axis(pd.RangeIndex(count, count + len(df)))
+            for feature in df.iterfeatures(na='null'):
+                fp.write(json.dumps(feature) + '\n')
+            count += len(df)
+    os.replace(path + '.part', path)
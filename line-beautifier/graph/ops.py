@@ -1,13 +1,19 @@
-import shapely
-import numpy as np
-import pandas as pd
-import geopandas as gpd
-import intervals as I
-from shapely.geometry import Point, LineString
-from functools import partial
-
-from map_matching.utils import dist_m, length_in_meters
+import os
+from collections import deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from map_matching.utils import dist_m
+from osm.corridor import METERS_PER_DEGREE
 from map_matcher.road_routing import AdHocNode
+from pipeline.imports import lazy_import
+shapely = lazy_import('shapely')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+
+
+# Ways are processed in parallel only if each worker gets this many edges
+MIN_PARTITION_SIZE = 2000
 
 
 class Node(object):
@@ -30,6 +36,10 @@ class Node(object):
             return False
         return True
 
+    def __hash__(self):
+        # equal nodes share their id (AdHoc nodes also need the location)
+        return hash(self.id)
+
     def __lt__(self, other):
         if not other:
             return True
@@ -45,87 +55,194 @@ class Node(object):
         return self.location > other.location
 
 
+class Segments(object):
+    """Lookup arrays of the edges (see `osm.convert.load_osm`), positioned by
+      edge id. Built once per network by `segment_table`, the graph operations
+      then look up nodes and coordinates by array indexing instead of per
+      node `edges.loc` calls.
+    """
+    def __init__(self, edges):
+        ids = edges['id'].values
+        self.row = np.full(ids.max() + 1 if len(ids) else 0, -1, dtype=np.int64)
+        self.row[ids] = np.arange(len(ids))
+        self.way_id = edges['way_id'].values
+        self.source = edges['source'].values
+        self.target = edges['target'].values
+        self.source_inter = edges['source_inter'].values
+        self.target_inter = edges['target_inter'].values
+        self.source_xy = np.column_stack((edges['source_lon'].values,
+                                          edges['source_lat'].values))
+        self.target_xy = np.column_stack((edges['target_lon'].values,
+                                          edges['target_lat'].values))
+        self.geometry = edges.geometry.values
+
+    def take(self, edge_ids):
+        """Returns the Segments of the edges `edge_ids` (unique) only."""
+        rows = self.row[edge_ids]
+        segments = Segments.__new__(Segments)
+        segments.row = np.full(len(self.row), -1, dtype=np.int64)
+        segments.row[edge_ids] = np.arange(len(rows))
+        for name in ('way_id', 'source', 'target', 'source_inter',
+                     'target_inter', 'source_xy', 'target_xy', 'geometry'):
+            setattr(segments, name, getattr(self, name)[rows])
+        return segments
+
+    def nodes(self, nodes):
+        """Returns the edge rows, node ids, AdHoc flags and locations of
+          `nodes` as arrays.
+        """
+        row = self.row[np.fromiter((n.edge_id for n in nodes), dtype=np.int64,
+                                   count=len(nodes))]
+        ids = np.fromiter((n.id for n in nodes), dtype=np.int64,
+                          count=len(nodes))
+        adhoc = np.fromiter((n.adhoc for n in nodes), dtype=bool,
+                            count=len(nodes))
+        location = np.fromiter((n.location for n in nodes), dtype=float,
+                               count=len(nodes))
+        return row, ids, adhoc, location
+
+    def is_intersection(self, nodes):
+        """Returns a boolean mask of the real street intersections in `nodes`."""
+        row, ids, adhoc, _ = self.nodes(nodes)
+        inter = np.where(ids == self.source[row], self.source_inter[row],
+                         self.target_inter[row])
+        return ~adhoc & inter
+
+    def points(self, nodes):
+        """Returns the coordinates (lon/lat) of `nodes` as (n, 2) array."""
+        row, ids, adhoc, location = self.nodes(nodes)
+        xy = np.where((ids == self.source[row])[:, None], self.source_xy[row],
+                      self.target_xy[row])
+        if adhoc.any():
+            xy[adhoc] = shapely.get_coordinates(shapely.line_interpolate_point(
+                self.geometry[row[adhoc]], location[adhoc], normalized=True))
+        return xy
+
+
+def segment_table(edges):
+    """Returns the `Segments` of `edges`. Pass it instead of `edges` to the
+      graph operations to build it only once per network.
+    """
+    if isinstance(edges, Segments):
+        return edges
+    return Segments(edges)
+
+
 class Path(object):
     def __init__(self, start, end):
-        self.path = [(start, end)]
+        self.path = deque([(start, end)])
         self.start = start
         self.end = end
 
     def add_first(self, start, end):
-        self.path.insert(0, (start, end))
+        self.path.appendleft((start, end))
         self.start = start
 
     def add_last(self, start, end):
         self.path.append((start, end))
         self.end = end
 
+    def join(self, other):
+        """Appends Path `other`, which starts where this one ends."""
+        if len(other.path) < len(self.path):
+            self.path.extend(other.path)
+        else:
+            other.path.extendleft(reversed(self.path))
+            self.path = other.path
+        self.end = other.end
+
 
 def list_edges(df, edges):
-    """Creates a DataFrame consisting of Edge objects found in `df`.
+    """Creates a DataFrame of the start and end Node of every matched edge.
       Arguments:
-        df: GeoDataFrame. Contains column `path`, created by our map matching.
-        edges: GeoDataFrame. Edges used in the map matching (see osm.convert.py).
+        df: DataFrame. The matched paths with columns `edge_id`, `start` and
+          `end` (locations), created by our map matching.
+        edges: GeoDataFrame or Segments. Edges used in the map matching (see
+          osm.convert.py), or their `segment_table`.
       Returns:
         DataFrame: Contains all edges found in `df`.
     """
-    if 'path' not in df.columns:
-        raise ValueError('DataFrame is expected to have column "path".')
-    way_id, edge_id, start, end = [], [], [], []
-    for _, row in df.iterrows():
-        for e in row['path']:
-            way_id.append(edges.loc[e.id, 'way_id'])
-            edge_id.append(e.id)
-            if e.reversed:
-                start.append(Node(e.end_node, e.id, e.end_node.location \
-                                  if isinstance(e.end_node, AdHocNode) else 0))
-                end.append(Node(e.start_node, e.id, e.start_node.location \
-                                if isinstance(e.start_node, AdHocNode) else 1))
+    for column in ('edge_id', 'start', 'end'):
+        if column not in df.columns:
+            raise ValueError('DataFrame is expected to have column "%s".'
+                             % column)
+    segments = segment_table(edges)
+    edge_id = df['edge_id'].values
+    row = segments.row[edge_id]
+    start, end = [], []
+    for nodes, column in ((start, 'start'), (end, 'end')):
+        location = df[column].values
+        # the OSM node at location 0 (1) is the source (target) of the edge
+        ids = np.where(location == 0, segments.source[row], segments.target[row])
+        for e, node, loc in zip(edge_id.tolist(), ids, location.tolist()):
+            if loc == 0 or loc == 1:
+                # intervals may also start at the target or end at the source
+                nodes.append(Node(node, e, int(loc)))
             else:
-                start.append(Node(e.start_node, e.id, e.start_node.location \
-                                  if isinstance(e.start_node, AdHocNode) else 0))
-                end.append(Node(e.end_node, e.id, e.end_node.location \
-                                if isinstance(e.end_node, AdHocNode) else 1))
-    return pd.DataFrame({'way_id': way_id,
+                nodes.append(Node(AdHocNode(edge_id=e, location=loc), e, loc))
+    return pd.DataFrame({'way_id': segments.way_id[row],
                          'edge_id': edge_id,
                          'start': start,
                          'end': end})
 
 
 def combine_edges(df, sparse=False):
-    way_id, edge_id, start, end = [], [], [], []
-    for name, group in df.groupby(['way_id', 'edge_id']):
-        intervals = I.empty()
-        for _, row in group.iterrows():
-            intervals = intervals | I.closed(row['start'], row['end'])
-        if not sparse:
-            intervals = intervals.enclosure()
-        for interval in intervals:
-            way_id.append(name[0])
-            edge_id.append(name[1])
-            start.append(interval.lower)
-            end.append(interval.upper)
-    return pd.DataFrame({'way_id': way_id,
-                         'edge_id': edge_id,
-                         'start': start,
-                         'end': end})
-
-
-def _interpolate_node(node, edges, pos, threshold):
-    """If `node` is not AdHoc, returns the closest start/end node of an edge
-      in `edges` within a distance of `threshold` meters.
+    """Merges the intervals (`start` to `end` node) of each edge into one
+      interval spanning all of them or, if `sparse`, into the disjoint
+      intervals of their union. Touching intervals are merged.
+      All rows are sorted by edge and start location once and merged in a
+      single sweep.
+      Typically, `df` is a DataFrame resulting from call `list_edges`.
     """
-    if not node.adhoc:
-        return node
-    lon1 = edges.loc[node.edge_id, pos + '_p'].x
-    lat1 = edges.loc[node.edge_id, pos + '_p'].y
-    p = edges.loc[node.edge_id, 'geometry'].interpolate(node.location,
-                                                        normalized=True)
-    lon2, lat2 = p.x, p.y
-    if dist_m(lon1, lat1, lon2, lat2) < threshold:
-        return Node(edges.loc[node.edge_id, pos], node.edge_id,
-                    0 if pos == 'source' else 1)
+    start_loc = np.fromiter((n.location for n in df['start']), dtype=float,
+                            count=len(df))
+    end_loc = np.fromiter((n.location for n in df['end']), dtype=float,
+                          count=len(df))
+    # intervals ending before they start are empty
+    keep = start_loc <= end_loc
+    way_id, edge_id = df['way_id'].values[keep], df['edge_id'].values[keep]
+    start, end = df['start'].values[keep], df['end'].values[keep]
+    start_loc, end_loc = start_loc[keep], end_loc[keep]
+    order = np.lexsort((start_loc, edge_id, way_id))
+    way_id, edge_id, start, end, start_loc, end_loc = way_id[order], \
+        edge_id[order], start[order], end[order], start_loc[order], end_loc[order]
+    new_edge = np.ones(len(order), dtype=bool)
+    new_edge[1:] = (way_id[1:] != way_id[:-1]) | (edge_id[1:] != edge_id[:-1])
+    if sparse:
+        # an interval starts after the furthest end of the previous ones
+        reach = pd.Series(end_loc).groupby(np.cumsum(new_edge)).cummax().values
+        new = new_edge.copy()
+        new[1:] |= start_loc[1:] > reach[:-1]
     else:
-        return node
+        new = new_edge
+    interval = np.cumsum(new) - 1
+    first = np.flatnonzero(new)
+    # the end of an interval is the end node furthest along the edge
+    last = np.lexsort((end_loc, interval))[
+        np.append(first[1:], len(order))[:len(first)] - 1]
+    return pd.DataFrame({'way_id': way_id[first],
+                         'edge_id': edge_id[first],
+                         'start': start[first],
+                         'end': end[last]})
+
+
+def _interpolate_nodes(nodes, segments, pos, threshold):
+    """Replaces AdHoc nodes in `nodes` by the start/end node (`pos`) of their
+      edge if it is within a distance of `threshold` meters.
+    """
+    nodes = list(nodes)
+    row, _, adhoc, _ = segments.nodes(nodes)
+    if not adhoc.any():
+        return nodes
+    end_xy = segments.source_xy if pos == 'source' else segments.target_xy
+    end_id = segments.source if pos == 'source' else segments.target
+    xy = segments.points(nodes)
+    close = adhoc & (dist_m(end_xy[row, 0], end_xy[row, 1],
+                            xy[:, 0], xy[:, 1]) < threshold)
+    for i in np.flatnonzero(close):
+        nodes[i] = Node(end_id[row[i]], nodes[i].edge_id,
+                        0 if pos == 'source' else 1)
+    return nodes
 
 
 def interpolate_edges(df, edges, threshold=10.):
@@ -133,19 +250,29 @@ def interpolate_edges(df, edges, threshold=10.):
       distance of `threshold` meters.
       Typically, `df` is a DataFrame resulting from call `combine_edges`.
     """
-    interpolate_start = partial(_interpolate_node, edges=edges,
-                                                   threshold=threshold,
-                                                   pos='source')
-    interpolate_end = partial(_interpolate_node, edges=edges,
-                                                 threshold=threshold,
-                                                 pos='target')
-    df.loc[:, 'start'] = df.loc[:, 'start'].apply(interpolate_start)
-    df.loc[:, 'end'] = df.loc[:, 'end'].apply(interpolate_end)
+    segments = segment_table(edges)
+    df.loc[:, 'start'] = pd.Series(_interpolate_nodes(df['start'], segments,
+                                                      'source', threshold),
+                                   index=df.index, dtype=object)
+    df.loc[:, 'end'] = pd.Series(_interpolate_nodes(df['end'], segments,
+                                                    'target', threshold),
+                                 index=df.index, dtype=object)
     return df
 
 
+def _pop(index, node, path):
+    """Removes `path` from the paths at `node` in `index`."""
+    paths = index[node]
+    paths.remove(path)
+    if not paths:
+        del index[node]
+
+
 def connect_edges(df):
     """All edges with the same `way_id` are tried to be connected.
+      The start and end nodes of all paths are indexed, so each edge is
+      attached in constant time. An edge which connects the end of one path
+      to the start of another joins both paths.
       Typically, `df` is a DataFrame resulting from call `interpolate_edges`.
       Returns:
         lines: List. Contains Path objects for all connected paths found.
@@ -153,60 +280,46 @@ def connect_edges(df):
     lines = []
     for name, group in df.groupby('way_id'):
         paths = []
-        for _, row in group.iterrows():
-            flag = True
-            for p in paths:
-                if row['end'] == p.start:
-                    p.add_first(row['start'], row['end'])
-                    flag = False
-                    break
-                elif row['start'] == p.end:
-                    p.add_last(row['start'], row['end'])
-                    flag = False
-                    break
-            if flag:
-                paths.append(Path(row['start'], row['end']))
-        lines += paths
+        starts, ends = defaultdict(list), defaultdict(list)
+        for start, end in zip(group['start'], group['end']):
+            before = ends[start][0] if start in ends else None
+            after = starts[end][0] if end in starts else None
+            if before is not None:
+                _pop(ends, start, before)
+                before.add_last(start, end)
+                if after is not None and after is not before:
+                    _pop(starts, end, after)
+                    _pop(ends, after.end, after)
+                    before.join(after)
+                    after.path = None
+                ends[before.end].append(before)
+            elif after is not None:
+                _pop(starts, end, after)
+                after.add_first(start, end)
+                starts[after.start].append(after)
+            else:
+                p = Path(start, end)
+                paths.append(p)
+                starts[start].append(p)
+                ends[end].append(p)
+        lines += [p for p in paths if p.path is not None]
     return lines
 
 
-def _is_intersection(node, edges):
-    """Returns True if `node` is a real street intersection."""
-    if node.adhoc:
-        return False
-    if node.id == edges.loc[node.edge_id, 'source']:
-        return edges.loc[node.edge_id, 'source_inter']
-    return edges.loc[node.edge_id, 'target_inter']
-
-
-def _to_point(node, edges):
-    """Converts a node to a Point object (lon/lat)."""
-    if node.adhoc:
-        return edges.loc[node.edge_id, 'geometry'].interpolate(node.location,
-                                                               normalized=True)
-    if node.id == edges.loc[node.edge_id, 'source']:
-        return edges.loc[node.edge_id, 'source_p']
-    return edges.loc[node.edge_id, 'target_p']
-
-
-def _get_points(nodes, edges):
-    """Converts a list of nodes to a list of Point objects."""
-    return [_to_point(n, edges) for n in nodes]
-
-
 def split_at_intersection(lines, edges):
     """All Paths in `lines` are split at real street intersections.
       Typically, `lines` is a List of Paths resulting from call `connect_edges`.
       Returns:
         DataFrame: Linesegments in form of list of nodes.
     """
+    segments = segment_table(edges)
+    paths = [[p.start] + [e[1] for e in p.path] for p in lines]
+    inter = segments.is_intersection([n for nodes in paths for n in nodes])
     nodes_lst = []
-    for p in lines:
-        nodes = [p.start] + [e[1] for e in p.path]
-        split = [0]
-        split += map(lambda x: 1+x[0],
-                     filter(lambda x: _is_intersection(x[1], edges),
-                            enumerate(nodes[1:])))
+    offset = 0
+    for nodes in paths:
+        split = [0] + list(np.flatnonzero(inter[offset + 1:offset + len(nodes)]) + 1)
+        offset += len(nodes)
         if split[-1] != len(nodes) - 1:
             split.append(len(nodes) - 1)
         for i in range(len(split) - 1):
@@ -214,22 +327,71 @@ def split_at_intersection(lines, edges):
     return pd.DataFrame({'nodes': nodes_lst})
 
 
-def _shorten_linestring(linestring, dist_small, dist_long, threshold):
-    """Shortens the given linestring at its beginning."""
-    length = length_in_meters(linestring)
-    dist = dist_small if length < threshold else dist_long
-    if length <= dist or dist <= 0:
-        return linestring
-    checkpoints = [linestring.project(Point(p), normalized=True) \
-                   for p in linestring.coords]
-    index = np.argmin([dist/length >= c for c in checkpoints])
-    p = linestring.interpolate(dist/length, normalized=True)
-    return LineString([(p.x, p.y)] + linestring.coords[index:])
-
-
-def _reverse_linestring(linestring):
-    """Reverses the ordering of the nodes of the given LineString."""
-    return LineString(linestring.coords[::-1])
+def _cumulative(values, counts):
+    """Returns the running sums of `values` within each line of `counts`
+      values, summed in the same order as `length_in_meters`.
+    """
+    if len(counts) == 0:
+        return values
+    return np.concatenate([np.cumsum(v) for v in
+                           np.split(values, np.cumsum(counts)[:-1])])
+
+
+def _lengths(xy, counts):
+    """Returns the length (meters) of each line of `counts` coordinates `xy`."""
+    ends = np.cumsum(counts)
+    meters = np.zeros(len(xy))
+    if len(xy) > 1:
+        meters[1:] = dist_m(xy[:-1, 0], xy[:-1, 1], xy[1:, 0], xy[1:, 1])
+    # no segment ends at the first vertex of a line
+    meters[(ends - counts)[counts > 0]] = 0.
+    length = np.zeros(len(counts))
+    length[counts > 0] = _cumulative(meters, counts)[ends[counts > 0] - 1]
+    return length
+
+
+def _shorten_starts(xy, counts, shorten, dist_small, dist_long, threshold):
+    """Shortens the lines flagged in `shorten` at their beginning. The lines
+      are given by their coordinates `xy` and the number of coordinates per
+      line `counts` (at least 2 each).
+      Returns:
+        Tuple. The coordinates and counts of the shortened lines.
+    """
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    line = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(len(xy)) - starts[line]
+    length = _lengths(xy, counts)
+    dist = np.where(length < threshold, dist_small, dist_long)
+    shorten = shorten & (length > dist) & (dist > 0)
+    if not shorten.any():
+        return xy, counts
+    fraction = np.divide(dist, length, out=np.zeros(len(counts)), where=shorten)
+    # the first vertex beyond the new start is the first one kept
+    planar = np.zeros(len(xy))
+    planar[1:] = np.hypot(*(xy[1:] - xy[:-1]).T)
+    planar[starts] = 0.
+    checkpoints = _cumulative(planar, counts)
+    checkpoints /= np.maximum(checkpoints[ends - 1], np.finfo(float).tiny)[line]
+    beyond = np.where(checkpoints > fraction[line], local, counts.max())
+    index = np.minimum.reduceat(beyond, starts)
+    index[index == counts.max()] = 0
+    index[~shorten] = 0
+    lines = shapely.linestrings(xy[shorten[line]],
+                                indices=(np.cumsum(shorten) - 1)[line[shorten[line]]])
+    p = shapely.get_coordinates(shapely.line_interpolate_point(
+        lines, fraction[shorten], normalized=True))
+    keep = local >= index[line]
+    kept = counts - index
+    xy = np.insert(xy[keep], (np.cumsum(kept) - kept)[shorten], p, axis=0)
+    return xy, kept + shorten
+
+
+def _reverse_lines(xy, counts):
+    """Reverses the ordering of the coordinates of every line."""
+    ends = np.cumsum(counts)
+    line = np.repeat(np.arange(len(counts)), counts)
+    return xy[(ends - 1)[line] + (ends - counts)[line] - np.arange(len(xy))]
 
 
 def to_linestring(df, edges, shorten_small=1.,
@@ -238,27 +400,162 @@ def to_linestring(df, edges, shorten_small=1.,
     """Converts sequences of nodes to LineString objects and shortens them.
       If the LineString is shorter than `threshold`, it gets trimmed by
       `shorten_small`. Otherwise `shorten_long` is used.
+      All lines are trimmed at once on their coordinate arrays, the
+      LineStrings are only created at the end.
       Typically, `df` is a DataFrame resulting from call `split_at_intersection`.
     """
-    geometries = []
-    for _, row in df.iterrows():
-        linestring = LineString(_get_points(row['nodes'], edges))
-        if _is_intersection(row['nodes'][0], edges):
-            linestring = _shorten_linestring(linestring, shorten_small,
-                                             shorten_long, threshold)
-        if _is_intersection(row['nodes'][-1], edges):
-            r_linestring = _reverse_linestring(linestring)
-            s_linestring = _shorten_linestring(r_linestring, shorten_small,
-                                               shorten_long, threshold)
-            linestring = _reverse_linestring(s_linestring)
-        geometries.append(linestring)
+    segments = segment_table(edges)
+    nodes = [n for lst in df['nodes'] for n in lst]
+    counts = np.fromiter((len(lst) for lst in df['nodes']), dtype=np.int64,
+                         count=len(df))
+    xy = segments.points(nodes)
+    inter = segments.is_intersection(nodes)
+    ends = np.cumsum(counts)
+    starts_inter, ends_inter = inter[ends - counts], inter[ends - 1]
+    xy, counts = _shorten_starts(xy, counts, starts_inter, shorten_small,
+                                 shorten_long, threshold)
+    xy, counts = _shorten_starts(_reverse_lines(xy, counts), counts,
+                                 ends_inter, shorten_small, shorten_long,
+                                 threshold)
+    xy = _reverse_lines(xy, counts)
+    geometries = shapely.linestrings(xy, indices=np.repeat(np.arange(len(counts)),
+                                                           counts))
     return gpd.GeoDataFrame({'geometry': geometries})
 
 
 def remove_short_linestrings(df, threshold=5.):
     """Removes geometries with length smaller than `threshold`."""
-    drop = []
-    for i, row in df.iterrows():
-        if length_in_meters(row['geometry']) < threshold:
-            drop.append(i)
-    return df.drop(drop)
+    xy, line = shapely.get_coordinates(df.geometry.values, return_index=True)
+    counts = np.bincount(line, minlength=len(df))
+    return df[_lengths(xy, counts) >= threshold]
+
+
+def simplify_linestrings(df, tolerance=None, precision=None):
+    """Simplifies the geometries in `df` for display.
+      Arguments:
+        tolerance: Float or None. Vertices which deviate less than this many
+          meters from the simplified line are dropped (Douglas-Peucker),
+          which removes collinear and nearly collinear vertices. The first
+          and last vertex of each line are always kept, so lines still meet
+          at intersections.
+        precision: Int or None. Number of decimal places the coordinates are
+          rounded to. Vertices which become duplicates are dropped, as are
+          lines which collapse to a single point.
+      Returns:
+        GeoDataFrame. A copy of `df` with the simplified geometries.
+    """
+    geometries = df.geometry.values
+    if tolerance:
+        # a degree of latitude is the longest, so no vertex moves further
+        geometries = shapely.simplify(geometries, tolerance / METERS_PER_DEGREE)
+    if precision is not None:
+        geometries = shapely.transform(geometries,
+                                       lambda xy: np.round(xy, precision))
+        geometries = shapely.remove_repeated_points(geometries)
+    df = df.copy()
+    df[df.geometry.name] = geometries
+    if precision is not None:
+        # a zero-length LineString is not valid
+        df = df[shapely.length(geometries) > 0]
+    return df
+
+
+def geometry_size(df):
+    """Returns the number of vertices of the geometries in `df` and the size
+      (bytes) of their GeoJSON representation.
+    """
+    geometries = df.geometry.values
+    return int(shapely.get_num_coordinates(geometries).sum()), \
+           sum(len(g) for g in shapely.to_geojson(geometries))
+
+
+def partition_ways(df, parts):
+    """Splits `df` into at most `parts` DataFrames of about the same number of
+      rows. All rows of a way (column `way_id`) end up in the same part and
+      the parts are ordered by way id.
+    """
+    df = df.iloc[np.argsort(df['way_id'].values, kind='stable')]
+    way_id = df['way_id'].values
+    if parts <= 1 or len(df) == 0:
+        return [df]
+    # rows at which a new way begins
+    starts = np.flatnonzero(np.r_[True, way_id[1:] != way_id[:-1]])
+    targets = np.arange(1, parts) * len(df) / float(parts)
+    cuts = np.unique(starts[np.minimum(np.searchsorted(starts, targets),
+                                       len(starts) - 1)])
+    cuts = cuts[cuts > 0]
+    bounds = np.r_[0, cuts, len(df)]
+    return [df.iloc[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def _split_ways(args):
+    """Runs the graph operations from `combine_edges` to
+      `split_at_intersection` on one partition.
+    """
+    df, segments, sparse, connect_dist = args
+    df = combine_edges(df, sparse)
+    df = interpolate_edges(df, segments, connect_dist)
+    lines = connect_edges(df)
+    return split_at_intersection(lines, segments)
+
+
+def split_ways(df, edges, sparse=False, connect_dist=5., workers=None):
+    """Runs `combine_edges` through `split_at_intersection` on the edges in
+      `df`. The ways are independent of each other, so they are split into
+      partitions (see `partition_ways`) which are processed by a pool of
+      `workers` processes; each worker only gets the lookup arrays of its
+      own edges. The results are concatenated in way order, which gives the
+      same lines in the same order as a single process.
+      Typically, `df` is a DataFrame resulting from call `list_edges`.
+      Arguments:
+        workers: Int or None. Number of processes, the number of CPUs if None.
+          Partitions hold at least `MIN_PARTITION_SIZE` edges.
+      Returns:
+        DataFrame. The sequences of nodes between intersections, see
+          `split_at_intersection`.
+    """
+    segments = segment_table(edges)
+    workers = workers or os.cpu_count() or 1
+    parts = partition_ways(df, min(workers, len(df) // MIN_PARTITION_SIZE))
+    args = [(part, segments.take(np.unique(part['edge_id'].values)), sparse,
+             connect_dist) for part in parts]
+    if len(parts) == 1:
+        results = [_split_ways(args[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=len(parts)) as executor:
+            results = list(executor.map(_split_ways, args))
+    return pd.concat(results, ignore_index=True)
+
+
+def shorten_ways(df, edges, shorten_small=1.,
+                            shorten_long=5.,
+                            shorten_threshold=20.,
+                            length_threshold=5.):
+    """Runs `to_linestring` and `remove_short_linestrings` on the lines of
+      all ways at once.
+      Typically, `df` is a DataFrame resulting from call `split_ways`.
+      Returns:
+        GeoDataFrame. The LineStrings.
+    """
+    df = to_linestring(df, edges, shorten_small, shorten_long,
+                       shorten_threshold)
+    return remove_short_linestrings(df, length_threshold).reset_index(drop=True)
+
+
+def process_ways(df, edges, sparse=False,
+                            connect_dist=5.,
+                            shorten_small=1.,
+                            shorten_long=5.,
+                            shorten_threshold=20.,
+                            length_threshold=5.,
+                            workers=None):
+    """Runs `combine_edges` through `remove_short_linestrings` on the edges
+      in `df`, see `split_ways` and `shorten_ways`.
+      Typically, `df` is a DataFrame resulting from call `list_edges`.
+      Returns:
+        GeoDataFrame. The LineStrings.
+    """
+    segments = segment_table(edges)
+    df = split_ways(df, segments, sparse, connect_dist, workers)
+    return shorten_ways(df, segments, shorten_small, shorten_long,
+                        shorten_threshold, length_threshold)
@@ -2,11 +2,12 @@ from __future__ import division
 
 import itertools
 
-from geopy.distance import geodesic
 
 from map_matcher import shortest_path
 from map_matcher import viterbi_path
 from map_matcher import road_routing
+from pipeline.imports import lazy_import, LazyObject
+pyproj = lazy_import('pyproj')
 
 try:
     from itertools import (
@@ -25,6 +26,10 @@ DEFAULT_SIGMA_Z = 4.07
 DEFAULT_MAX_ROUTE_DISTANCE = 2000
 
 
+# Geodesic distances are based on WGS 84 spheroid
+GEOD = LazyObject(lambda: pyproj.Geod(ellps='WGS84'))
+
+
 class Candidate(object):
     """Candidate object associated to measurements."""
     def __init__(self, measurement, edge, distance, location):
@@ -99,6 +104,28 @@ def set_directions(candidates):
     # only single candidate, it's direction is unknown.
 
 
+def group_measurements(candidates):
+    """Return the measurements of the candidates, one per state."""
+    groups = itertools.groupby(candidates, key=lambda c: c.group_key)
+    return [next(group).measurement for _, group in groups]
+
+
+def measurement_distances(measurements):
+    """
+    Calculate the geodesic distances between consecutive measurements
+    in one vectorized pass. Return a dictionary which maps a pair of
+    measurement IDs (source, target) to their distance in meters.
+    """
+    if len(measurements) < 2:
+        return {}
+    sources, targets = measurements[:-1], measurements[1:]
+    _, _, distances = GEOD.inv([m.lon for m in sources],
+                               [m.lat for m in sources],
+                               [m.lon for m in targets],
+                               [m.lat for m in targets])
+    return {(s.id, t.id): d for s, t, d in zip(sources, targets, distances)}
+
+
 class MapMatching(viterbi_path.ViterbiSearch):
     def __init__(self, get_road_edges,
                  max_route_distance=DEFAULT_MAX_ROUTE_DISTANCE,
@@ -112,6 +139,9 @@ class MapMatching(viterbi_path.ViterbiSearch):
         if sigma_z < 0:
             raise ValueError('expect sigma_z to be positive (sigma_z={0})'.format(sigma_z))
         self.sigma_z = sigma_z
+        # Distances between consecutive measurements, filled before
+        # the search starts (see offline_match)
+        self.measurement_distances = {}
         super(MapMatching, self).__init__()
 
     def calculate_transition_cost(self, source, target):
@@ -126,10 +156,8 @@ class MapMatching(viterbi_path.ViterbiSearch):
         except shortest_path.PathNotFound as err:
             # Not reachable
             return -1
-        # Geodesic distance based on WGS 84 spheroid
-        great_circle_distance = geodesic(
-            (source.measurement.lat, source.measurement.lon),
-            (target.measurement.lat, target.measurement.lon)).meters
+        great_circle_distance = self.calculate_measurement_distance(
+            source.measurement, target.measurement)
         delta = abs(route_distance - great_circle_distance)
         return delta / self.beta
 
@@ -149,10 +177,8 @@ class MapMatching(viterbi_path.ViterbiSearch):
             self.get_road_edges,
             max_path_cost=max_route_distance)
 
-        # Geodesic distance based on WGS 84 spheroid
-        great_circle_distance = geodesic(
-            (source.measurement.lat, source.measurement.lon),
-            (target_measurement.lat, target_measurement.lon)).meters
+        great_circle_distance = self.calculate_measurement_distance(
+            source.measurement, target_measurement)
 
         costs = []
         for target, (path, route_distance) in zip(targets, route_results):
@@ -178,7 +204,24 @@ class MapMatching(viterbi_path.ViterbiSearch):
     def calculate_max_route_distance(self, source_mmt, target_mmt):
         return self.max_route_distance
 
+    def calculate_measurement_distance(self, source_mmt, target_mmt):
+        """
+        Return the geodesic distance between two measurements. It is
+        looked up from the precomputed table and only calculated if
+        the pair is missing (e.g. during online matching).
+        """
+        distance = self.measurement_distances.get((source_mmt.id, target_mmt.id))
+        if distance is None:
+            _, _, distance = GEOD.inv(source_mmt.lon, source_mmt.lat,
+                                      target_mmt.lon, target_mmt.lat)
+        return distance
+
     def offline_match(self, candidates):
+        # Offline matching knows all candidates, so the distances
+        # between consecutive states are calculated once up front
+        candidates = list(candidates)
+        self.measurement_distances = measurement_distances(
+            group_measurements(candidates))
         winners = list(self.offline_search(candidates))
         set_directions(winners)
         for winner in winners:
@@ -220,10 +263,8 @@ class NaiveMapMatching(viterbi_path.NaiveViterbiSearch, MapMatching):
             self.get_road_edges,
             max_path_cost=max_route_distance)
 
-        # Geodesic distance based on WGS 84 spheroid
-        great_circle_distance = geodesic(
-            (source.measurement.lat, source.measurement.lon),
-            (target_measurement.lat, target_measurement.lon)).meters
+        great_circle_distance = self.calculate_measurement_distance(
+            source.measurement, target_measurement)
 
         costs = []
         for target, (path, route_distance) in zip(targets, route_results):
@@ -1,10 +1,11 @@
-import numpy as np
-from shapely.geometry import LineString, Polygon
-
 from .utils import dist_m, shift
+from .network import Location
 from map_matcher.map_matching import Candidate, MapMatching
 from map_matcher.utils import Edge, Measurement
 from map_matcher.road_routing import AdHocNode
+from pipeline.imports import lazy_import
+np = lazy_import('numpy')
+shapely = lazy_import('shapely')
 
 
 # TODO come up with reasonable defaults
@@ -15,12 +16,34 @@ DEFAULT_SEARCH_RADIUS = 20
 
 def to_circle(p, radius, n=36):
     """Returns a circle-like polygon with center `p`."""
-    return Polygon([shift(p.x, p.y, i * (360./n), radius) for i in range(n)])
+    return shapely.Polygon([shift(p.x, p.y, i * (360./n), radius) for i in range(n)])
+
+
+def _project(p, e, p_buffered):
+    """Projects `p` onto each edge of the polyline of the contracted edge `e`
+      which intersects `p_buffered`, the same way as onto a single edge.
+      Locations along the contracted edge are derived from `e.offsets`.
+      Returns:
+        List. (Location, projected Point) per edge.
+    """
+    coords = np.asarray(e.geometry.coords)
+    segments = shapely.linestrings(np.stack((coords[:-1], coords[1:]), axis=1))
+    offsets = e.offsets
+    projections = []
+    for i in np.flatnonzero(shapely.intersects(segments, p_buffered)):
+        segment_location = segments[i].project(p, normalized=True)
+        p_on_edge = segments[i].interpolate(segment_location, normalized=True)
+        location = (offsets[i] + segment_location * (offsets[i+1] - offsets[i])) \
+                   / offsets[-1] if offsets[-1] > 0 else 0.
+        projections.append((Location(location, e['first'] + i, segment_location),
+                            p_on_edge))
+    return projections
 
 
 def query_candidates(idx, edges, sequence, search_radius):
     """Creates Candidate objects for each Point in `sequence`.
       Considers only edges within a distance of `search_radius`.
+      `edges` are contracted edges (see `map_matching.network.contract_edges`).
     """
     # TODO print warning if no edge within distance of `search_radius`
     candidates = []
@@ -29,16 +52,15 @@ def query_candidates(idx, edges, sequence, search_radius):
         p_buffered = to_circle(p, search_radius)
         for eid in list(idx.intersection(p_buffered.bounds)):
             e = edges.loc[eid]
-            if e.geometry.intersects(p_buffered):
-                length = dist_m(e.geometry.coords[0][0], e.geometry.coords[0][1],
-                                e.geometry.coords[1][0], e.geometry.coords[1][1])
-                edge = Edge(id=e.id,
-                            start_node=e.source,
-                            end_node=e.target,
-                            cost=length,
-                            reverse_cost=length)
-                location = e.geometry.project(p, normalized=True)
-                p_on_edge = e.geometry.interpolate(location, normalized=True)
+            if not e.geometry.intersects(p_buffered):
+                continue
+            edge = Edge(id=e.id,
+                        start_node=e.source,
+                        end_node=e.target,
+                        cost=e['length'],
+                        reverse_cost=e['length'])
+            # one candidate per OSM edge within `search_radius`
+            for location, p_on_edge in _project(p, e, p_buffered):
                 distance = dist_m(p.x, p.y, p_on_edge.x, p_on_edge.y)
                 candidate = Candidate(measurement=measurement, edge=edge,
                                       location=location, distance=distance)
@@ -1,27 +1,72 @@
-import geopandas as gpd
-from tqdm import tqdm
-from rtree import index
+import os
+import hashlib
 
-from osm.query_overpass import query_overpass
+from osm.query_overpass import query_overpass, query_bounds, PATH_CACHE
+from osm.cache import cache_key, in_use
 from osm.convert import load_osm
+from osm.extract import load_extract
+from osm.corridor import corridor, area_km2
 from .map_match import map_match, DEFAULT_BETA, DEFAULT_SIGMA_Z
+from .network import contract_edges, expand_path
 from .utils import linestring_to_sequence
+from pipeline.imports import lazy_import
+shapely = lazy_import('shapely')
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+tqdm = lazy_import('tqdm')
+rtree = lazy_import('rtree')
+
+
+# Streets are loaded up to this distance (meters) beyond `search_radius`,
+# so that paths between candidates can leave the search radius
+DEFAULT_ROUTING_MARGIN = 200.
 
 
 class PathBrokenException(Exception):
     """Raises when a path between two Candidates is broken."""
 
 
-def build_rtee(df):
-    """Builds an R-Tree of the given geometries in `df`."""
+def build_rtee(df, path=None):
+    """Builds an R-Tree of the given geometries in `df`.
+      The R-Tree is bulk loaded from the bounds of all geometries at once.
+      If `path` is given, the R-Tree is stored on disk (`path` + `.idx` and
+      `.dat`) and reopened from there instead of being rebuilt next time.
+    """
     if 'id' not in df.columns:
         raise ValueError('DataFrame is expected to have column "id".')
     if 'geometry' not in df.columns:
         raise ValueError('DataFrame is expected to have column "geometry".')
-    idx = index.Index()
-    for _, row in df.iterrows():
-        idx.insert(row['id'], row['geometry'].bounds)
-    return idx
+    stream = ((id, tuple(bounds), None)
+              for id, bounds in zip(df['id'].tolist(),
+                                    df.geometry.bounds.values.tolist()))
+    if not path:
+        return rtree.index.Index(stream)
+    # other jobs must not evict the files until they are opened
+    with in_use(os.path.dirname(path)):
+        if os.path.exists(path + '.idx') and os.path.exists(path + '.dat'):
+            return rtree.index.Index(path)
+        # one of both files might be left over, e.g. after cache eviction
+        for ext in ('.idx', '.dat'):
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+        # the index is only complete once closed, so it is built under a
+        # temporary name, which a crash cannot leave behind as a broken index
+        tmp = '%s.%d' % (path, os.getpid())
+        rtree.index.Index(tmp, stream).close()
+        for ext in ('.idx', '.dat'):
+            os.replace(tmp + ext, path + ext)
+        return rtree.index.Index(path)
+
+
+def make_index_path(sources, cache=PATH_CACHE):
+    """Returns the location of the R-Tree of the contracted network, stored next
+      to the cached OSM data.
+      The location changes whenever one of the cached files in `sources` does.
+    """
+    if not cache or not all(isinstance(s, str) for s in sources):
+        return None
+    return os.path.join(cache, 'rtree_network_' + cache_key(sources))
 
 
 def _verify_matched_path(candidates, sequence, tol=0.95):
@@ -49,10 +94,143 @@ def build_path(candidates):
     return path
 
 
+def streets_key(edges):
+    """Returns a key of the OSM `edges`, which changes whenever their ids,
+      nodes or coordinates do, e.g. once the cached OSM data is refreshed.
+      Results referring to edge ids can be cached under it.
+    """
+    h = hashlib.sha1()
+    for column in ('id', 'way_id', 'source', 'target', 'source_lon',
+                   'source_lat', 'target_lon', 'target_lat'):
+        h.update(np.ascontiguousarray(edges[column].values))
+    return h.hexdigest()
+
+
+class PreparedNetwork(object):
+    """The streets within `area`, ready for map matching: the OSM `edges`,
+      the contracted `network` (see `map_matching.network`) and its R-Tree
+      `index`, stored at `index_path` if it is on disk. Created by
+      `prepare_network`, it can be reused for all geometries within `area`.
+    """
+    def __init__(self, area, edges, network, index, index_path=None):
+        self.area = area
+        self.edges = edges
+        self.network = network
+        self.index = index
+        self.index_path = index_path
+        self._key = None
+
+    def reopen(self):
+        """Reopens the R-Tree if it is on disk. Forked processes have to, as
+          the file offsets of an inherited index are shared with the parent
+          and its other children, which breaks concurrent reads.
+        """
+        if self.index_path:
+            self.index = rtree.index.Index(self.index_path)
+
+    @property
+    def key(self):
+        """A key of the streets, see `streets_key`."""
+        if self._key is None:
+            self._key = streets_key(self.edges)
+        return self._key
+
+    def covers(self, geometries, search_radius):
+        """Returns True if all streets within `search_radius` meters of
+          `geometries` are part of the network.
+        """
+        return self.area.covers(corridor(geometries, search_radius))
+
+
+def load_streets(geometries,
+                 search_radius=20.,
+                 verbose=True,
+                 cache=PATH_CACHE,
+                 extract=None,
+                 routing_margin=DEFAULT_ROUTING_MARGIN):
+    """Loads the streets within `search_radius` plus `routing_margin` meters
+      of `geometries`, without preparing them for map matching (see
+      `prepare_network`). See `map_geolocations` for the arguments.
+      Returns:
+        area: Polygon. The area covered by the streets.
+        edges: GeoDataFrame. The edges loaded from OSM.
+        index_path: String or None. Location of the cached R-Tree of the
+          streets (see `make_index_path`), None if it is not cached.
+    """
+    area = corridor(geometries, search_radius + routing_margin)
+    bounds = area.bounds
+    if verbose and extract:
+        print('Loading streets within %.2f km² (bounding box: %.2f km²)'
+              % (area_km2(area), area_km2(shapely.box(*bounds))))
+    elif verbose:
+        # all streets of the tiles intersecting the corridor are loaded
+        loaded = shapely.union_all([shapely.box(*b) for b in
+                                    query_bounds(bounds, cache, area=area)])
+        print('Loading streets within %.2f km² around a corridor of %.2f km² '
+              '(bounding box: %.2f km²)'
+              % (area_km2(loaded), area_km2(area),
+                 area_km2(shapely.box(*bounds))))
+    if extract:
+        return area, load_osm(load_extract(extract, bounds, area)), None
+    # the cached tiles must not be evicted by other jobs until they are read
+    with in_use(cache):
+        map = query_overpass(bounds, cache=cache, parse=False, area=area)
+        return area, load_osm(map), make_index_path(map, cache)
+
+
+def network_from_streets(area, edges, index_path=None):
+    """Prepares the streets loaded by `load_streets` for map matching.
+      Returns:
+        PreparedNetwork.
+    """
+    network = contract_edges(edges)
+    return PreparedNetwork(area, edges, network, build_rtee(network, index_path),
+                           index_path)
+
+
+def prepare_network(geometries,
+                    search_radius=20.,
+                    verbose=True,
+                    cache=PATH_CACHE,
+                    extract=None,
+                    routing_margin=DEFAULT_ROUTING_MARGIN):
+    """Loads the streets within `search_radius` plus `routing_margin` meters
+      of `geometries` (e.g. the geometries to match or the polygon of a
+      service area) and prepares them for map matching.
+      See `map_geolocations` for the arguments.
+      Returns:
+        PreparedNetwork.
+    """
+    return network_from_streets(*load_streets(geometries, search_radius,
+                                              verbose, cache, extract,
+                                              routing_margin))
+
+
+def match_line(geometry, index, network, sequence_interval, search_radius):
+    """Matches a LineString to the contracted `network` with R-Tree `index`.
+      Returns:
+        List or None. The matched path (see `network.expand_path`), None if
+          no path was found.
+    """
+    sequence = linestring_to_sequence(geometry, sequence_interval)
+    candidates = map_match(index, network, sequence, search_radius,
+                           beta=DEFAULT_BETA, sigma=DEFAULT_SIGMA_Z)
+    try:
+        _verify_matched_path(candidates, sequence)
+    except PathBrokenException:
+        return None
+    return expand_path(build_path(candidates), network)
+
+
 def map_geolocations(geolocations,
                      sequence_interval=5.,
                      search_radius=20.,
-                     verbose=True):
+                     verbose=True,
+                     cache=PATH_CACHE,
+                     extract=None,
+                     routing_margin=DEFAULT_ROUTING_MARGIN,
+                     network=None,
+                     checkpoint=None):
     """The given geometries are matched to OSM data.
       Note that only LineStrings are matched.
       Arguments:
@@ -60,37 +238,69 @@ def map_geolocations(geolocations,
         sequence_interval: Float. Interval for splitting linestrings.
         search_radius: Float. Consider only streets within this distance.
         verbose: Boolean. Whether to print progress and unmatched LineStrings.
+        cache: String or None. Directory where OSM data and the R-Tree are
+          cached. If None, nothing is cached.
+        extract: String or None. Local OSM extract (or an index created by
+          `osm.extract.build_extract_index`) to read the streets from. If
+          None, streets are queried from Overpass.
+        routing_margin: Float. Only streets within `search_radius` plus this
+          distance (meters) of the geometries are loaded. The corridor covers
+          each cluster of geometries separately, instead of their bounding box.
+        network: PreparedNetwork or None. Streets prepared by a previous call
+          of `prepare_network`, which must cover the geometries. If None,
+          the streets are loaded.
+        checkpoint: Checkpoint or None. Paths of LineStrings matched before
+          (with the same streets and parameters) are taken from the
+          checkpoint (see `pipeline.checkpoint`), new ones are added to it.
       Returns:
-         mapped_geoms: GeoDataFrame. Contains `path` with matched edges.
+         mapped_geoms: GeoDataFrame. The given geometries, `modified` marks
+           the matched ones.
          edges: GeoDataFrame. The edges downloaded from OSM.
+         paths: DataFrame. The matched paths, one row per edge in `edges`
+           with columns `line` (index in `mapped_geoms`), `edge_id`,
+           `reversed` and `start` and `end` location (0 to 1, in edge
+           direction). Streets are matched on the contracted network (see
+           `map_matching.network`).
     """
     if 'geometry' not in geolocations.columns:
         raise ValueError('DataFrame is expected to have column "geometry".')
     mapped_geoms = geolocations.copy()
     mapped_geoms.loc[:, 'modified'] = False
-    mapped_geoms.loc[:, 'path'] = None
-    bounds = (geolocations.bounds.minx.min(), geolocations.bounds.miny.min(),
-              geolocations.bounds.maxx.max(), geolocations.bounds.maxy.max())
-    map = query_overpass(bounds)
-    edges = load_osm(map)
-    idx = build_rtee(edges)
+    if network is None:
+        network = prepare_network(geolocations.geometry.values, search_radius,
+                                  verbose, cache, extract, routing_margin)
+    elif not network.covers(geolocations.geometry.values, search_radius):
+        raise ValueError('The prepared network does not cover the geometries.')
+    edges, contracted, idx = network.edges, network.network, network.index
     unmatched_lines = []
+    paths = []
     linestrings = mapped_geoms[mapped_geoms.geom_type == 'LineString']
-    for i, row in tqdm(linestrings.iterrows(), total=len(linestrings),
+    for i, row in tqdm.tqdm(linestrings.iterrows(), total=len(linestrings),
                                                disable=not verbose):
-        sequence = linestring_to_sequence(row['geometry'], sequence_interval)
-        candidates = map_match(idx, edges, sequence, search_radius,
-                               beta=DEFAULT_BETA, sigma=DEFAULT_SIGMA_Z)
-        try:
-            _verify_matched_path(candidates, sequence)
-            mapped_geoms.at[i, 'path'] = build_path(candidates)
+        key = None if checkpoint is None else \
+              checkpoint.key('line', row['geometry'].wkb, sequence_interval,
+                             search_radius, network.key)
+        if key is not None and key in checkpoint:
+            path = checkpoint[key]
+        else:
+            path = match_line(row['geometry'], idx, contracted,
+                              sequence_interval, search_radius)
+            if key is not None:
+                checkpoint.add(key, path)
+        if path is not None:
+            paths += [(i,) + e for e in path]
             mapped_geoms.loc[i, 'modified'] = True
-        except PathBrokenException:
+        else:
             unmatched_lines.append(row['geometry'])
             if verbose:
-                tqdm.write('No match found for geometry %d/%d'
+                tqdm.tqdm.write('No match found for geometry %d/%d'
                            % (i+1, len(mapped_geoms)))
     if len(unmatched_lines) > 0 and verbose:
         print('\nUnmatched LineStrings:')
         print(gpd.GeoDataFrame({'geometry': unmatched_lines}).to_json())
-    return mapped_geoms, edges
+    paths = pd.DataFrame(paths, columns=['line', 'edge_id', 'start', 'end',
+                                         'reversed'])
+    # keep the types if no LineString was matched
+    paths = paths.astype({'edge_id': 'int64', 'start': float, 'end': float,
+                          'reversed': bool})
+    return mapped_geoms, edges, paths
@@ -0,0 +1,103 @@
+from map_matcher.road_routing import AdHocNode
+from .utils import GEOD
+from pipeline.imports import lazy_import
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+shapely = lazy_import('shapely')
+gpd = lazy_import('geopandas')
+
+
+class Location(float):
+    """Location (0 to 1) along a contracted edge, which also knows the edge
+      between two OSM nodes it lies on (`segment`) and the location along that
+      edge (`segment_location`). The map matcher uses it like any location,
+      AdHocNodes created at a candidate keep it.
+    """
+    def __new__(cls, location, segment, segment_location):
+        self = float.__new__(cls, location)
+        self.segment = segment
+        self.segment_location = segment_location
+        return self
+
+
+def contract_edges(edges):
+    """Contracts chains of edges between real street intersections (or the
+      ends of a way) into single edges, which are used for routing.
+      Edges of a way are consecutive in `edges` (see `osm.convert.load_osm`),
+      so each contracted edge covers the range `first` to `first + count - 1`
+      of edge ids. Its geometry is the full polyline of these edges and
+      `offsets` holds the cumulative length (meters) at each of its nodes.
+      Arguments:
+        edges: GeoDataFrame. The edges between consecutive OSM nodes.
+      Returns:
+        GeoDataFrame. The contracted edges, with columns `id`, `way_id`,
+          `source`, `target`, `source_inter`, `target_inter`, `first`,
+          `count`, `length`, `offsets` and `geometry`.
+    """
+    n = len(edges)
+    source, target = edges['source'].values, edges['target'].values
+    way_id = edges['way_id'].values
+    # a chain ends at an intersection, at the end of a way or at a gap
+    last = np.ones(n, dtype=bool)
+    last[:-1] = edges['target_inter'].values[:-1] | \
+                (way_id[1:] != way_id[:-1]) | (target[:-1] != source[1:])
+    ends = np.flatnonzero(last)
+    first = np.concatenate(([0], ends[:-1] + 1)) if n else ends
+    count = ends - first + 1
+    lengths = GEOD.inv(edges['source_lon'].values, edges['source_lat'].values,
+                       edges['target_lon'].values, edges['target_lat'].values)[2]
+    cum = np.concatenate(([0.], np.cumsum(lengths)))
+    offsets = [cum[f:e + 2] - cum[f] for f, e in zip(first, ends)]
+    # polylines: the sources of all edges of a chain plus its last target
+    chain = np.repeat(np.arange(len(first)), count)
+    xy = np.empty((n + len(first), 2))
+    xy[np.arange(n) + chain] = np.column_stack((edges['source_lon'].values,
+                                                edges['source_lat'].values))
+    xy[ends + np.arange(len(first)) + 1] = np.column_stack(
+        (edges['target_lon'].values[ends], edges['target_lat'].values[ends]))
+    geometry = shapely.linestrings(xy, indices=np.repeat(np.arange(len(first)),
+                                                         count + 1))
+    df = gpd.GeoDataFrame({'source': source[first],
+                           'target': target[ends],
+                           'source_inter': edges['source_inter'].values[first],
+                           'target_inter': edges['target_inter'].values[ends],
+                           'way_id': way_id[first],
+                           'first': first,
+                           'count': count,
+                           'length': cum[ends + 1] - cum[first],
+                           'offsets': pd.Series(offsets, dtype=object),
+                           'id': np.arange(len(first), dtype=np.int32)},
+                          geometry=geometry)
+    df.set_index('id', drop=False, inplace=True)
+    return df
+
+
+def expand_path(path, network):
+    """Maps a path of contracted edges back to the edges they were contracted
+      from. AdHocNodes are located by the edge and location the candidates
+      were projected onto (see `Location`), so partially used edges start
+      and end at exactly the same locations as without contraction.
+      Returns:
+        List. Tuples (edge id, start location, end location, reversed) of the
+          edges in path order; locations (0 to 1) are in edge direction.
+    """
+    expanded = []
+    for e in path:
+        start, end = (e.end_node, e.start_node) if e.reversed \
+                     else (e.start_node, e.end_node)
+        first = network['first'].values[e.id]
+        last = first + network['count'].values[e.id] - 1
+        a = (start.location.segment, start.location.segment_location) \
+            if isinstance(start, AdHocNode) else (first, 0.)
+        b = (end.location.segment, end.location.segment_location) \
+            if isinstance(end, AdHocNode) else (last, 1.)
+        segments = []
+        for k in range(a[0], b[0] + 1):
+            lower = a[1] if k == a[0] else 0.
+            upper = b[1] if k == b[0] else 1.
+            # skip edges which are only touched at one end
+            if (lower == 1. and k < b[0]) or (upper == 0. and k > a[0]):
+                continue
+            segments.append((k, lower, upper, e.reversed))
+        expanded += segments[::-1] if e.reversed else segments
+    return expanded
@@ -1,8 +1,9 @@
-import numpy as np
-import pyproj
+from pipeline.imports import lazy_import, LazyObject
+np = lazy_import('numpy')
+pyproj = lazy_import('pyproj')
 
 
-GEOD = pyproj.Geod(ellps='WGS84')
+GEOD = LazyObject(lambda: pyproj.Geod(ellps='WGS84'))
 
 
 def length_in_meters(linestring):
@@ -1,11 +1,27 @@
+import time
+_STARTED = time.perf_counter()
 import os
-import json
+import glob
+import atexit
 import argparse
-import pandas as pd
-import geopandas as gpd
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 import graph.ops
-from map_matching.map_matching import map_geolocations
+from geodata.formats import read_geolocations, iter_batches, \
+                            write_geolocations, detect_format, from_arrow, \
+                            to_arrow, EXTENSIONS, FORMATS, GEOJSON, WGS84
+from map_matching.map_matching import map_geolocations, prepare_network, \
+                                      load_streets, network_from_streets, \
+                                      streets_key
+from osm.cache import cache_key
+from osm.query_overpass import PATH_CACHE
+from pipeline.checkpoint import Checkpoint, checkpoint_path
+from pipeline.stages import Pipeline, frame_key
+from pipeline.imports import lazy_import, report_imports
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
 
 
 COLOR_MODIFIED = '#4CAF50'
@@ -15,17 +31,18 @@ STROKE_WIDTH = 3.
 
 
 def load_geolocations(path):
-    """Loads a GeoJSON file from a given path."""
-    return gpd.read_file(path)
+    """Loads a GeoJSON, GeoJSONSeq, GeoParquet or FlatGeobuf file (told by
+      its extension) from a given path. Files with another extension are
+      read by `geopandas.read_file`.
+    """
+    return read_geolocations(path)
 
 
-def save_geolocations(df, path):
-    """Saves a GeoDataFrame to a given path."""
-    try:
-        json.dump(json.loads(df.to_json()), open(path, 'w'))
-    except UnicodeDecodeError:
-        # Needed for special characters (workaround for now)
-        json.dump(json.loads(df.to_json(encoding='latin-1')), open(path, 'w'))
+def save_geolocations(df, path, format=None):
+    """Saves a GeoDataFrame to a given path, in `format` (see
+      `geodata.formats.FORMATS`) or, if None, told by the extension of `path`.
+    """
+    write_geolocations([df], path, format)
 
 
 def merge_geolocations(df_unmodified, df_modified,
@@ -35,6 +52,299 @@ def merge_geolocations(df_unmodified, df_modified,
                         df_modified[columns]
                      ], ignore_index=True)
 
+def _match(geolocations, network, **kwargs):
+    # the edges are left out, they are loaded again rather than cached
+    mapped_geoms, _, paths = map_geolocations(geolocations, network=network,
+                                              **kwargs)
+    return mapped_geoms, paths
+
+
+def _segments(streets):
+    return graph.ops.segment_table(streets[1])
+
+
+def _lines(matched, segments, sparse, connect_dist, workers):
+    df = graph.ops.list_edges(matched[1], segments)
+    return graph.ops.split_ways(df, segments, sparse, connect_dist, workers)
+
+
+def optimize_geolocations(geolocations,
+                          sequence_interval=5.,
+                          search_radius=20.,
+                          connect_dist=5.,
+                          shorten_dist_small=1.,
+                          shorten_dist_long=5.,
+                          shorten_dist_threshold=20.,
+                          length_threshold=5.,
+                          sparse=False,
+                          color=False,
+                          verbose=True,
+                          extract=None,
+                          workers=None,
+                          simplify=None,
+                          precision=None,
+                          network=None,
+                          checkpoint=None,
+                          stage_cache=None):
+    """Performs the geolocation optimization for the LineStrings in a
+      GeoDataFrame. See `optimize` for the arguments.
+      Arguments:
+        network: PreparedNetwork or None. Streets prepared once with
+          `map_matching.map_matching.prepare_network`, which cover the
+          geometries. If None, the streets are loaded for each call.
+        checkpoint: Checkpoint or None. Records the matched LineStrings, see
+          `map_matching.map_matching.map_geolocations`.
+        stage_cache: String or None. Directory where the outputs of the map
+          matching and of the graph operations up to the splitting are
+          cached (see `pipeline.stages`). If None, all stages are run.
+      Returns:
+        GeoDataFrame. The optimized geometries and column `modified`.
+    """
+    # the last stage always needs the edges, so the streets are loaded first
+    # and the cached stages are keyed by the edges they refer to
+    if network is None:
+        streets = load_streets(geolocations.geometry.values, search_radius,
+                               verbose, extract=extract)
+    else:
+        streets = (network.area, network.edges, None)
+    pipeline = Pipeline(stage_cache, verbose=verbose)
+    pipeline.add('geolocations', lambda: geolocations,
+                 key=frame_key(geolocations), cached=False)
+    pipeline.add('streets', lambda: streets, key=streets_key(streets[1]),
+                 cached=False)
+    if network is None:
+        # the contracted network is only built if the matching is not cached
+        pipeline.add('network', lambda streets: network_from_streets(*streets),
+                     ['streets'], cached=False)
+    else:
+        pipeline.add('network', lambda streets: network, ['streets'],
+                     cached=False)
+    pipeline.add('match', partial(_match, verbose=verbose,
+                                  checkpoint=checkpoint),
+                 ['geolocations', 'network'],
+                 dict(sequence_interval=sequence_interval,
+                      search_radius=search_radius))
+    pipeline.add('segments', _segments, ['streets'], cached=False)
+    pipeline.add('lines', partial(_lines, workers=workers),
+                 ['match', 'segments'], dict(sparse=sparse,
+                                             connect_dist=connect_dist))
+    pipeline.add('linestrings', graph.ops.shorten_ways, ['lines', 'segments'],
+                 dict(shorten_small=shorten_dist_small,
+                      shorten_long=shorten_dist_long,
+                      shorten_threshold=shorten_dist_threshold,
+                      length_threshold=length_threshold), cached=False)
+    df_mapped = pipeline.run('match')[0]
+    df_unmodified = df_mapped[df_mapped.modified == False]
+    df = pipeline.run('linestrings')
+    if simplify or precision is not None:
+        before = graph.ops.geometry_size(df)
+        df = graph.ops.simplify_linestrings(df, simplify, precision)
+        after = graph.ops.geometry_size(df)
+        if verbose:
+            print('Simplified matched LineStrings: %d -> %d vertices, '
+                  '%.1f -> %.1f kB (%.0f%% saved)'
+                  % (before[0], after[0], before[1] / 1e3, after[1] / 1e3,
+                     100. * (1 - after[1] / float(max(before[1], 1)))))
+    df['modified'] = True
+    df_final = merge_geolocations(df_unmodified, df,
+                                  ['geometry', 'modified'])
+    if color:
+        df_final.loc[:, 'stroke-width'] = STROKE_WIDTH
+        df_final.loc[:, 'stroke'] = COLOR_POLYGONS
+        df_final.loc[df_final.modified == True, 'stroke'] = COLOR_MODIFIED
+        loc_unmodified_linestrings = (df_final.modified == False) & \
+                                     (df_final.geom_type == 'LineString')
+        df_final.loc[loc_unmodified_linestrings, 'stroke'] = COLOR_UNMODIFIED
+    return df_final
+
+
+def optimize_data(data, geometry='geometry', crs=WGS84, **kwargs):
+    """Performs the geolocation optimization in memory, no files are read or
+      written (apart from the OSM cache).
+      Arguments:
+        data: GeoDataFrame or Arrow data. Arrow tables, record batches and
+          objects exporting an Arrow stream need WKB encoded geometries in
+          column `geometry`, with coordinates in `crs`.
+        kwargs: See `optimize_geolocations`, e.g. `network` to reuse streets
+          prepared with `map_matching.map_matching.prepare_network`.
+      Returns:
+        GeoDataFrame or pyarrow Table, like `data`: the optimized geometries
+          and column `modified` (plus the styling columns if `color`).
+    """
+    if isinstance(data, gpd.GeoDataFrame):
+        return optimize_geolocations(data, **kwargs)
+    # only the geometries are used, the other columns are not converted
+    df = optimize_geolocations(from_arrow(data, geometry, crs, columns=[]),
+                               **kwargs)
+    return to_arrow(df.rename_geometry(geometry)
+                    if geometry != df.geometry.name else df)
+
+
+def _optimize_batches(batches, checkpoint, key, network, kwargs):
+    """Yields the optimized `batches`, taken from `checkpoint` if they were
+      finished before.
+    """
+    for i, geolocations in enumerate(batches):
+        batch_key = None if checkpoint is None else checkpoint.key(key, i)
+        if batch_key is not None and batch_key in checkpoint:
+            yield checkpoint[batch_key]
+            continue
+        df = optimize_geolocations(geolocations, network=network,
+                                   checkpoint=checkpoint, **kwargs)
+        if checkpoint is not None:
+            checkpoint.add(batch_key, df)
+            checkpoint.flush()
+        yield df
+
+
+def _write_optimized(batches, path_in, path_out, format, kwargs,
+                     batch_size=None, network=None, checkpoint=True,
+                     resume=False):
+    """Optimizes the `batches` read from `path_in` and writes them to
+      `path_out`. With `checkpoint`, finished work is recorded next to the
+      output (see `pipeline.checkpoint`) until the output is complete.
+    """
+    key = None
+    if checkpoint:
+        checkpoint = Checkpoint(checkpoint_path(path_out), resume)
+        params = sorted((k, v) for k, v in kwargs.items()
+                        if k not in ('verbose', 'workers', 'stage_cache'))
+        key = checkpoint.key('batch', cache_key([path_in]), batch_size,
+                             network.key if network else None, params)
+    else:
+        checkpoint = None
+    try:
+        write_geolocations(_optimize_batches(batches, checkpoint, key, network,
+                                             kwargs), path_out, format)
+    except BaseException:
+        if checkpoint is not None:
+            checkpoint.close()
+        raise
+    if checkpoint is not None:
+        checkpoint.close(remove=True)
+
+
+def output_path(path_in, dir_out=None, format=None):
+    """Returns the default output path of `path_in`: the same name plus the
+      suffix `_optimized` and the extension of `format` (GeoJSON if None),
+      in directory `dir_out` or else next to the input.
+    """
+    name = os.path.splitext(os.path.basename(path_in))[0] + '_optimized' + \
+           EXTENSIONS[format or GEOJSON][0]
+    return os.path.join(dir_out or os.path.dirname(path_in), name)
+
+
+def input_paths(pattern):
+    """Returns the input files in directory `pattern` or matching the glob
+      `pattern`, sorted: all files of a supported format, except outputs
+      named by `output_path`.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*')
+    paths = []
+    for path in sorted(glob.glob(pattern)):
+        try:
+            detect_format(path)
+        except ValueError:
+            continue
+        name = os.path.basename(path)
+        if os.path.isfile(path) and \
+           not os.path.splitext(name)[0].endswith('_optimized'):
+            paths.append(path)
+    return paths
+
+
+# The network shared by `optimize_many`, inherited by its worker processes
+_network = None
+
+
+def _init_job():
+    _network.reopen()
+
+
+def _optimize_file(args):
+    path_in, path_out, format, resume, kwargs = args
+    _write_optimized([load_geolocations(path_in)], path_in, path_out, format,
+                     kwargs, network=_network, resume=resume)
+    return path_out
+
+
+def optimize_many(pattern,
+                  dir_out=None,
+                  jobs=None,
+                  search_radius=20.,
+                  verbose=True,
+                  extract=None,
+                  format=None,
+                  resume=False,
+                  **kwargs):
+    """Optimizes many files, e.g. all files of a region, with one network.
+      The streets around all files are loaded and indexed once, then the
+      files are optimized by `jobs` processes, each one written to its own
+      output file (see `output_path`).
+      Arguments:
+        pattern: String. A directory or a glob pattern of input files.
+        dir_out: String or None. Directory of the output files. If None, each
+          output is written next to its input.
+        jobs: Int or None. Number of files optimized at the same time, the
+          number of CPUs if None. Processes are forked to share the network,
+          where this is not supported the files are optimized one by one.
+        resume: Boolean. Whether to resume files which were interrupted
+          before, see `optimize`.
+        kwargs: See `optimize`.
+      Returns:
+        List. The paths of the output files, in the order of the inputs.
+    """
+    global _network
+    paths = input_paths(pattern)
+    if not paths:
+        raise ValueError('No input files found at "%s".' % pattern)
+    # inputs which only differ in their directory or extension must not
+    # overwrite each other's output
+    paths_out, inputs = [], {}
+    for path in paths:
+        path_out = output_path(path, dir_out, format)
+        if path_out in inputs:
+            raise ValueError('"%s" and "%s" would both be written to "%s".'
+                             % (inputs[path_out], path, path_out))
+        inputs[path_out] = path
+        paths_out.append(path_out)
+    if dir_out:
+        os.makedirs(dir_out, exist_ok=True)
+    geometries = pd.concat([load_geolocations(p).geometry for p in paths])
+    _network = prepare_network(geometries.values, search_radius, verbose,
+                               extract=extract)
+    jobs = min(jobs or os.cpu_count() or 1, len(paths))
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        jobs = 1
+    kwargs.setdefault('stage_cache', PATH_CACHE)
+    if jobs > 1:
+        # the files are the parallel unit, not the ways within a file
+        if kwargs.get('workers') is None:
+            kwargs['workers'] = 1
+    kwargs.update(search_radius=search_radius, verbose=False)
+    args = [(p, path_out, format, resume, kwargs)
+            for p, path_out in zip(paths, paths_out)]
+    try:
+        if jobs == 1:
+            results = map(_optimize_file, args)
+        else:
+            executor = ProcessPoolExecutor(
+                max_workers=jobs, mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_job)
+            results = executor.map(_optimize_file, args)
+        outputs = []
+        for path_in, path_out in zip(paths, results):
+            outputs.append(path_out)
+            if verbose:
+                print('%s -> %s' % (path_in, path_out))
+    finally:
+        if jobs > 1:
+            executor.shutdown()
+        _network = None
+    return outputs
+
+
 def optimize(path_in,
              path_out=None,
              sequence_interval=5.,
@@ -46,13 +356,23 @@ def optimize(path_in,
              length_threshold=5.,
              sparse=False,
              color=False,
-             verbose=True):
+             verbose=True,
+             extract=None,
+             workers=None,
+             batch_size=None,
+             format=None,
+             simplify=None,
+             precision=None,
+             checkpoint=True,
+             resume=False,
+             stage_cache=PATH_CACHE):
     """Performs the geolocation optimization for LineStrings.
       Arguments:
-        path_in: String. Path to the input GeoJSON file.
+        path_in: String. Path to the input file (GeoJSON, GeoJSONSeq,
+          GeoParquet or FlatGeobuf, told by the extension).
         path_out: String or None. Path to the output file. If None, the cleaned
           up file is saved at the same location as the input file, plus the
-          suffix `_cleaned.geojson`.
+          suffix `_optimized` and the extension of `format`.
         sequence_interval: Float. Interval for splitting linestrings.
         search_radius: Float. Consider only streets within this distance.
         connect_dist: Float. Distance for connecting linestrings to OSM nodes.
@@ -63,43 +383,72 @@ def optimize(path_in,
         sparse: Boolean. Whether to split LineStrings at driveways etc.
         color: Boolean. Whether to colour matched LineStrings.
         verbose: Boolean. Whether to print progress and unmatched LineStrings.
+        extract: String or None. Local OSM extract (XML or PBF) or extract
+          index to use instead of the Overpass API.
+        workers: Int or None. Processes for the graph operations after the
+          map matching, the number of CPUs if None.
+        batch_size: Int or None. If given, the input is read, optimized and
+          written in batches of this many features, which bounds the memory
+          needed for large files. Each batch is matched and cleaned up on its
+          own, so overlaps between LineStrings of different batches are not
+          merged. If None, all features are optimized at once. FlatGeobuf
+          output is still written at once, only the input is batched.
+        format: String or None. Output format, one of `geodata.formats.FORMATS`.
+          If None, it is told by the extension of `path_out` (GeoJSON if
+          `path_out` is None).
+        simplify: Float or None. Drop vertices of matched LineStrings which
+          deviate less than this many meters from a straight line, e.g.
+          collinear OSM nodes. Start and end points are kept.
+        precision: Int or None. Round the coordinates of matched LineStrings
+          to this many decimal places.
+        checkpoint: Boolean. Whether to record the matched LineStrings and the
+          optimized batches in `path_out` + `.checkpoint` while the input is
+          optimized. The checkpoint is deleted once the output is complete.
+        resume: Boolean. Whether to resume from the checkpoint of a run which
+          was interrupted: LineStrings and batches finished before are not
+          optimized again, as long as the input and parameters are the same.
+        stage_cache: String or None. Directory where the outputs of the map
+          matching and the graph operations are cached, keyed by their inputs
+          and parameters. Running again with e.g. other shorten distances
+          only re-runs the stages after the splitting. If None, nothing is
+          cached.
     """
-    geolocations = load_geolocations(path_in)
-    df_mapped, edges = map_geolocations(geolocations, sequence_interval,
-                                        search_radius, verbose)
-    df_unmodified = df_mapped[df_mapped.modified == False]
-    df_modified = df_mapped[df_mapped.modified == True]
-    df = graph.ops.list_edges(df_modified, edges)
-    df = graph.ops.combine_edges(df, sparse)
-    df = graph.ops.interpolate_edges(df, edges, connect_dist)
-    lines = graph.ops.connect_edges(df)
-    df = graph.ops.split_at_intersection(lines, edges)
-    df = graph.ops.to_linestring(df, edges, shorten_dist_small,
-                                            shorten_dist_long,
-                                            shorten_dist_threshold)
-    df = graph.ops.remove_short_linestrings(df, length_threshold)
-    df['modified'] = True
-    df_final = merge_geolocations(df_unmodified, df,
-                                  ['geometry', 'modified'])
-    if color:
-        df_final.loc[:, 'stroke-width'] = STROKE_WIDTH
-        df_final.loc[:, 'stroke'] = COLOR_POLYGONS
-        df_final.loc[df_final.modified == True, 'stroke'] = COLOR_MODIFIED
-        loc_unmodified_linestrings = (df_final.modified == False) & \
-                                     (df_final.geom_type == 'LineString')
-        df_final.loc[loc_unmodified_linestrings, 'stroke'] = COLOR_UNMODIFIED
     if not path_out:
-        path_out = os.path.splitext(path_in)[0] + '_optimized.geojson'
-    save_geolocations(df_final, path_out)
+        path_out = output_path(path_in, format=format)
+    format = detect_format(path_out, format, default=GEOJSON)
+    if batch_size:
+        batches = iter_batches(path_in, batch_size)
+    else:
+        batches = [load_geolocations(path_in)]
+    kwargs = dict(sequence_interval=sequence_interval,
+                  search_radius=search_radius,
+                  connect_dist=connect_dist,
+                  shorten_dist_small=shorten_dist_small,
+                  shorten_dist_long=shorten_dist_long,
+                  shorten_dist_threshold=shorten_dist_threshold,
+                  length_threshold=length_threshold,
+                  sparse=sparse,
+                  color=color,
+                  verbose=verbose,
+                  extract=extract,
+                  workers=workers,
+                  simplify=simplify,
+                  precision=precision,
+                  stage_cache=stage_cache)
+    # batches are written while the next ones are still being optimized
+    _write_optimized(batches, path_in, path_out, format, kwargs, batch_size,
+                     checkpoint=checkpoint, resume=resume)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--input', '-i', required=True, type=str,
-                        help='path to the input file')
+                        help='path to the input file, or a directory or '
+                             'glob pattern of input files')
     parser.add_argument('--output', '-o', required=False, type=str,
                         default=None,
-                        help='path to the output file')
+                        help='path to the output file (output directory '
+                             'for many input files)')
     parser.add_argument('--length', '-l', required=False, type=float,
                         default=5.,
                         help='sample interval to create measurements')
@@ -128,16 +477,88 @@ if __name__ == '__main__':
                         help='matched linestrings are coloured')
     parser.add_argument('--silent', '-S', required=False, action='store_true',
                         help='suppresses all printed output')
+    parser.add_argument('--extract', '-e', required=False, type=str,
+                        default=None,
+                        help='local OSM extract or extract index to use '
+                             'instead of Overpass')
+    parser.add_argument('--workers', '-w', required=False, type=int,
+                        default=None,
+                        help='processes for the graph operations '
+                             '(default: number of CPUs)')
+    parser.add_argument('--batch-size', '-b', required=False, type=int,
+                        default=None,
+                        help='optimize the input in batches of this many '
+                             'features')
+    parser.add_argument('--format', '-f', required=False, type=str,
+                        default=None, choices=FORMATS,
+                        help='output format (default: by the extension of '
+                             'the output file, else geojson)')
+    parser.add_argument('--simplify', '-sI', required=False, type=float,
+                        default=None,
+                        help='drop vertices of matched linestrings deviating '
+                             'less than this (meters) from a straight line')
+    parser.add_argument('--precision', '-p', required=False, type=int,
+                        default=None,
+                        help='round coordinates of matched linestrings to '
+                             'this many decimal places')
+    parser.add_argument('--jobs', '-j', required=False, type=int,
+                        default=None,
+                        help='input files optimized at the same time '
+                             '(default: number of CPUs)')
+    parser.add_argument('--resume', '-R', required=False, action='store_true',
+                        help='resume an interrupted run from its checkpoint')
+    parser.add_argument('--no-cache', '-NC', required=False,
+                        action='store_true',
+                        help='do not cache the outputs of the map matching '
+                             'and graph operations')
+    parser.add_argument('--import-report', '-IR', required=False,
+                        action='store_true',
+                        help='print the time taken by the imports when done')
     args = parser.parse_args()
-    optimize(path_in=args.input,
-             path_out=args.output,
-             sequence_interval=args.length,
-             search_radius=args.radius,
-             connect_dist=args.connect,
-             shorten_dist_small=args.shorten1,
-             shorten_dist_long=args.shorten2,
-             shorten_dist_threshold=args.shorten3,
-             length_threshold=args.threshold,
-             sparse=args.sparse,
-             color=args.color,
-             verbose=not args.silent)
+    if args.import_report:
+        atexit.register(report_imports, _STARTED)
+    stage_cache = None if args.no_cache else PATH_CACHE
+    if os.path.isdir(args.input) or glob.has_magic(args.input):
+        if args.batch_size:
+            parser.error('--batch-size is not supported for many input files')
+        optimize_many(pattern=args.input,
+                      dir_out=args.output,
+                      jobs=args.jobs,
+                      sequence_interval=args.length,
+                      search_radius=args.radius,
+                      connect_dist=args.connect,
+                      shorten_dist_small=args.shorten1,
+                      shorten_dist_long=args.shorten2,
+                      shorten_dist_threshold=args.shorten3,
+                      length_threshold=args.threshold,
+                      sparse=args.sparse,
+                      color=args.color,
+                      verbose=not args.silent,
+                      extract=args.extract,
+                      workers=args.workers,
+                      format=args.format,
+                      resume=args.resume,
+                      stage_cache=stage_cache,
+                      simplify=args.simplify,
+                      precision=args.precision)
+    else:
+        optimize(path_in=args.input,
+                 path_out=args.output,
+                 sequence_interval=args.length,
+                 search_radius=args.radius,
+                 connect_dist=args.connect,
+                 shorten_dist_small=args.shorten1,
+                 shorten_dist_long=args.shorten2,
+                 shorten_dist_threshold=args.shorten3,
+                 length_threshold=args.threshold,
+                 sparse=args.sparse,
+                 color=args.color,
+                 verbose=not args.silent,
+                 extract=args.extract,
+                 workers=args.workers,
+                 batch_size=args.batch_size,
+                 format=args.format,
+                 simplify=args.simplify,
+                 precision=args.precision,
+                 resume=args.resume,
+                 stage_cache=stage_cache)
@@ -0,0 +1,175 @@
+import os
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: # not available on Windows, tiles are not locked there
+    fcntl = None
+
+
+# Tiles older than this (seconds) are fetched again
+DEFAULT_TTL = 30 * 24 * 3600
+# Least recently used files are deleted once the cache exceeds this (bytes)
+DEFAULT_MAX_SIZE = 2 ** 30
+
+
+def tile_path(cache, tile, size):
+    """Returns the location of a cached tile (compressed JSON)."""
+    return os.path.join(cache, 'tiles', str(size), '%d_%d.json.gz' % tile)
+
+
+def is_fresh(path, ttl=DEFAULT_TTL):
+    """Returns True if `path` exists and is not older than `ttl` seconds."""
+    if not os.path.exists(path):
+        return False
+    return ttl is None or time.time() - os.path.getmtime(path) < ttl
+
+
+def touch(path):
+    """Marks `path` as used. The access time records the last use, the
+      modification time keeps the time the file was written.
+    """
+    os.utime(path, (time.time(), os.path.getmtime(path)))
+
+
+@contextmanager
+def lock(path):
+    """Holds an exclusive lock on `path` (via `path`.lock) across processes."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'a') as fp:
+        if fcntl:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+# Shared locks of the caches used by this process: cache -> [file, count]
+_in_use = {}
+_in_use_lock = threading.Lock()
+if hasattr(os, 'register_at_fork'):
+    # the locks stay with the parent, which releases them
+    os.register_at_fork(after_in_child=_in_use.clear)
+
+
+def _cache_lock(cache):
+    if not os.path.isdir(cache):
+        os.makedirs(cache, exist_ok=True)
+    return open(os.path.join(cache, 'cache.lock'), 'a')
+
+
+@contextmanager
+def in_use(cache):
+    """Marks `cache` as used by this process (a shared lock) while files are
+      checked and opened, so that other processes do not evict them in the
+      meantime (see `evict`). Can be nested.
+    """
+    if not cache or not fcntl:
+        yield
+        return
+    cache = os.path.abspath(cache)
+    with _in_use_lock:
+        if cache not in _in_use:
+            fp = _cache_lock(cache)
+            fcntl.flock(fp, fcntl.LOCK_SH)
+            _in_use[cache] = [fp, 0]
+        _in_use[cache][1] += 1
+    try:
+        yield
+    finally:
+        with _in_use_lock:
+            entry = _in_use[cache]
+            entry[1] -= 1
+            if entry[1] == 0:
+                fcntl.flock(entry[0], fcntl.LOCK_UN)
+                entry[0].close()
+                del _in_use[cache]
+
+
+@contextmanager
+def _evicting(cache):
+    """Holds an exclusive lock on `cache` if no other process uses it, yields
+      whether it does.
+    """
+    if not fcntl:
+        yield True
+        return
+    cache = os.path.abspath(cache)
+    with _in_use_lock:
+        entry = _in_use.get(cache)
+        # the shared lock of this process is converted, not locked twice
+        fp = entry[0] if entry else _cache_lock(cache)
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            acquired = True
+        except OSError:
+            acquired = False
+        try:
+            yield acquired
+        finally:
+            if entry:
+                fcntl.flock(fp, fcntl.LOCK_SH)
+            else:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+                fp.close()
+
+
+def cache_key(paths):
+    """Returns a key which changes whenever one of the files in `paths` does."""
+    h = hashlib.sha1()
+    for path in paths:
+        st = os.stat(path)
+        h.update(('%s:%d:%d;' % (path, st.st_mtime_ns, st.st_size)).encode())
+    return h.hexdigest()
+
+
+def _group(path):
+    """Files which are only usable together are evicted together."""
+    if path.endswith('.idx') or path.endswith('.dat'):
+        return path[:-4]
+    return path
+
+
+def evict(cache, max_size=DEFAULT_MAX_SIZE, keep=()):
+    """Deletes the least recently used files until the total size of `cache`
+      is at most `max_size` bytes. Files in `keep` are never deleted. While
+      another process uses the cache (see `in_use`), nothing is deleted;
+      the next call evicts instead.
+    """
+    with _evicting(cache) as acquired:
+        if acquired:
+            _evict(cache, max_size, keep)
+
+
+def _evict(cache, max_size, keep):
+    groups = {}
+    for root, _, names in os.walk(cache):
+        for name in names:
+            if name.endswith('.lock') or name.endswith('.part'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            atime, size, paths = groups.get(_group(path), (0, 0, []))
+            groups[_group(path)] = (max(atime, st.st_atime),
+                                    size + st.st_size, paths + [path])
+    total = sum(size for _, size, _ in groups.values())
+    keep = set([_group(path) for path in keep])
+    for key, (_, size, paths) in sorted(groups.items(), key=lambda g: g[1][0]):
+        if total <= max_size:
+            break
+        if key in keep:
+            continue
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
@@ -1,100 +1,308 @@
+import os
+import re
+import gzip
 import json
-import numpy as np
-import geopandas as gpd
+import codecs
+import itertools
 
-from shapely.geometry import Point, LineString
+from array import array
 from collections import defaultdict
 
+from pipeline.imports import lazy_import
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
 
-def _helper(ways, node_count, del_way_ids, n, id1, id2, ind):
-    """Helper function to reduce code in `merge_ways`."""
-    for x in ways[id2]['ref']:
-        ways[x] = ways[id1]
-    ways[id2] = ways[id1]
-    ways[id1]['ref'] += [id2] + ways[id2]['ref']
-    del node_count[n][1]
-    del_way_ids.add(id2)
+
+READ_SIZE = 1 << 16
+_WHITESPACE = re.compile(r'\s*')
+_NUMBER_CHARS = '0123456789.eE+-'
+
+
+class _JSONStream(object):
+    """Decodes JSON values one at a time from a file object."""
+    def __init__(self, fp, size=READ_SIZE):
+        self.fp = fp
+        self.size = size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self):
+        chunk = self.fp.read(self.size)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError('Unexpected end of JSON data.')
+            self._read()
+
+    def expect(self, char):
+        """Consumes the next non-whitespace character, which must be `char`."""
+        if self.peek() != char:
+            raise ValueError('Expected "%s" in JSON data.' % char)
+        self.pos += 1
+
+    def value(self):
+        """Decodes and consumes the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer might be cut off
+                if self.eof or (end < len(self.buffer) and
+                                self.buffer[end] not in _NUMBER_CHARS):
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.eof:
+                    raise
+            self._read()
+
+
+def stream_array(fp, name, members=None):
+    """Yields the entries of the array `name` of the JSON object read from
+      `fp` one at a time. Other members are skipped or, if `members` is a
+      Dict, stored in it as soon as they are read.
+    """
+    stream = _JSONStream(fp)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == name:
+            stream.expect('[')
+            while stream.peek() != ']':
+                yield stream.value()
+                if stream.peek() == ',':
+                    stream.expect(',')
+            stream.expect(']')
+        elif members is not None:
+            members[key] = stream.value()
+        else:
+            stream.value()
+        if stream.peek() == '}':
+            return
+        stream.expect(',')
+
+
+def _stream_elements(fp):
+    """Yields the elements of an OSM JSON document read from `fp`."""
+    return stream_array(fp, 'elements')
+
+
+def iter_elements(data):
+    """Yields the elements of OSM data in JSON format one at a time.
+      Arguments:
+        data: Dict, String, file object or List. If String, the JSON file at
+          this location (optionally gzip compressed) is read incrementally.
+          The same applies to file objects, e.g. the body of an HTTP response.
+          If List, the elements of all its entries are yielded in order.
+    """
+    if isinstance(data, dict):
+        for obj in data['elements']:
+            yield obj
+    elif isinstance(data, str):
+        opener = gzip.open if data.endswith('.gz') else open
+        with opener(data, 'rt', encoding='utf-8') as fp:
+            for obj in _stream_elements(fp):
+                yield obj
+    elif hasattr(data, 'read'):
+        if isinstance(data.read(0), bytes):
+            data = codecs.getreader('utf-8')(data)
+        for obj in _stream_elements(data):
+            yield obj
+    elif isinstance(data, (list, tuple)):
+        for d in data:
+            for obj in iter_elements(d):
+                yield obj
+    else:
+        raise ValueError('Argument `data` is expected to be a dictionary, '
+                         'a path, a file object or a list of those.')
+
+
+def merge_elements(data):
+    """Yields the elements of all OSM data in `data` (see `iter_elements`),
+      duplicates are removed.
+    """
+    seen = set([])
+    for obj in iter_elements(data):
+        key = (obj['type'], obj['id'])
+        if key not in seen:
+            seen.add(key)
+            yield obj
+
+
+def write_elements(elements, path):
+    """Writes OSM elements to a JSON file at `path`, one at a time. The file
+      is gzip compressed if `path` ends with `.gz`.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path + '.part', 'wt', encoding='utf-8') as fp:
+        fp.write('{"elements": [')
+        for i, obj in enumerate(elements):
+            fp.write((',\n' if i else '\n') + json.dumps(obj))
+        fp.write('\n]}\n')
+    # an interrupted write must not leave a truncated file behind
+    os.replace(path + '.part', path)
+
+
+def _find(root, id):
+    """Returns the id of the way which `id` has been merged into."""
+    while root[id] != id:
+        root[id] = root[root[id]]
+        id = root[id]
+    return id
+
+
+def _stitch(ways, joints, first_way, first_node):
+    """Walks along the chain of merged ways starting at `first_node` of way
+      `first_way` and returns the nodes of all ways and their ids.
+    """
+    nodes, ids = [], []
+    id, entry = first_way, first_node
+    while id is not None:
+        way_nodes = ways[id]['nodes']
+        if way_nodes[0] != entry:
+            way_nodes = way_nodes[::-1]
+        nodes.extend(way_nodes if not nodes else way_nodes[1:])
+        ids.append(id)
+        id, entry = joints[id].get(way_nodes[-1]), way_nodes[-1]
+    return nodes, ids
 
 
-# TODO function needs refactoring
 def merge_ways(ways, node_count):
-    """Merges ways which are not an intersection but are broken up in OSM."""
-    del_way_ids = set([])
+    """Merges ways which are not an intersection but are broken up in OSM.
+      Two ways are merged at node `n` if `n` is the first or last node of
+      both and no other way contains `n`. The merges are decided on the ends
+      of each chain of ways only; the nodes of each chain are stitched
+      together in a single walk at the end.
+    """
+    root = {id: id for id in ways}
+    # (first node, its way, last node, its way) of each chain
+    ends = {id: (w['nodes'][0], id, w['nodes'][-1], id)
+            for id, w in ways.items() if w['nodes']}
+    joints = defaultdict(dict)
     for n in node_count:
         # the second evaluation accounts for closed roundabouts
         # with way['nodes'][0] == way['nodes'][-1]
-        if len(node_count[n]) == 2 and node_count[n][0] != node_count[n][1]:
-            id1, id2 = node_count[n]
-            if (ways[id1]['nodes'][0] == n or ways[id1]['nodes'][-1] == n) and \
-               (ways[id2]['nodes'][0] == n or ways[id2]['nodes'][-1] == n):
-                if not 'ref' in ways[id1]:
-                    ways[id1]['ref'] = []
-                if not 'ref' in ways[id2]:
-                    ways[id2]['ref'] = []
-                if ways[id1]['nodes'][0] == n and ways[id2]['nodes'][0] == n:
-                    ways[id1]['nodes'] = ways[id1]['nodes'][::-1] + ways[id2]['nodes'][1:]
-                    _helper(ways, node_count, del_way_ids, n, id1, id2, 1)
-                elif ways[id1]['nodes'][-1] == n and ways[id2]['nodes'][-1] == n:
-                    ways[id1]['nodes'] += ways[id2]['nodes'][:-1][::-1]
-                    _helper(ways, node_count, del_way_ids, n, id1, id2, 1)
-                elif ways[id2]['nodes'][0] == n and ways[id1]['nodes'][0] != n:
-                    ways[id1]['nodes'] += ways[id2]['nodes'][1:]
-                    _helper(ways, node_count, del_way_ids, n, id1, id2, 1)
-                else:
-                    ways[id2]['nodes'] += ways[id1]['nodes'][1:]
-                    _helper(ways, node_count, del_way_ids, n, id2, id1, 0)
-    for id in del_way_ids:
+        if len(node_count[n]) != 2 or node_count[n][0] == node_count[n][1]:
+            continue
+        id1, id2 = node_count[n]
+        r1, r2 = _find(root, id1), _find(root, id2)
+        # the ways already form a ring
+        if r1 == r2:
+            continue
+        f1, fw1, l1, lw1 = ends[r1]
+        f2, fw2, l2, lw2 = ends[r2]
+        if n not in (f1, l1) or n not in (f2, l2):
+            continue
+        if f1 == n and f2 == n:
+            root[r2], ends[r1] = r1, (l1, lw1, l2, lw2)
+        elif l1 == n and l2 == n:
+            root[r2], ends[r1] = r1, (f1, fw1, f2, fw2)
+        elif f2 == n and f1 != n:
+            root[r2], ends[r1] = r1, (f1, fw1, l2, lw2)
+        else:
+            root[r1], ends[r2] = r2, (f2, fw2, l1, lw1)
+        joints[id1][n] = id2
+        joints[id2][n] = id1
+        del node_count[n][1]
+    merged = set([_find(root, id) for id in joints])
+    for r in merged:
+        first_node, first_way, _, _ = ends[r]
+        nodes, ids = _stitch(ways, joints, first_way, first_node)
+        ways[r]['nodes'] = nodes
+        ways[r]['ref'] = [id for id in ids if id != r]
+    for id in [id for id in ways if root[id] != id]:
         del ways[id]
     return ways, node_count
 
 
-def load_osm(data):
+def _lookup(coords, node_ids, ids):
+    """Returns the coordinates of the nodes `ids`; `node_ids` is sorted."""
+    pos = np.minimum(np.searchsorted(node_ids, ids), max(len(node_ids) - 1, 0))
+    if len(ids) > 0 and (len(node_ids) == 0 or np.any(node_ids[pos] != ids)):
+        raise ValueError('OSM data is missing nodes referenced by ways.')
+    return coords[pos].reshape(-1, 2)
+
+
+def load_osm(data, geometry=True):
     """Takes OSM data as input and converts it to a GeoDataFrame.
+      The elements are streamed into node coordinate and segment index arrays,
+      no objects are created per segment. Duplicate elements are skipped.
       Arguments:
-        data: Dict or String. The OSM data in JSON format. If String, a JSON
-          file at this location is tried to be openend.
+        data: Dict, String, file object or List. The OSM data in JSON format
+          (see `iter_elements`).
+        geometry: Boolean. Whether to create the geometries of all edges. If
+          False, a DataFrame with the edge coordinates only is returned.
       Returns:
         df: GeoDataFrame. Contains all edges found in `data`.
     """
-    if isinstance(data, str):
-        data = json.load(open(data, 'r'))
-    if not isinstance(data, dict):
-        raise ValueError('Argument `data` is expected to be a dictionary.')
-    nodes, ways = {}, {}
+    node_ids, lon, lat = array('q'), array('d'), array('d')
+    ways = {}
     node_count = defaultdict(list)
-    for obj in data['elements']:
+    for obj in iter_elements(data):
         if obj['type'] == 'node':
-            nodes[obj['id']] = obj
-        else:
-            ways[obj['id']] = obj
+            node_ids.append(obj['id'])
+            lon.append(obj['lon'])
+            lat.append(obj['lat'])
+        elif obj['type'] == 'way' and obj['id'] not in ways:
+            ways[obj['id']] = {'id': obj['id'], 'nodes': obj['nodes']}
             for n in obj['nodes']:
                 node_count[n].append(obj['id'])
     # this step accounts for "broken up" OSM streets
     ways, node_count = merge_ways(ways, node_count)
-    geom, source, target, source_p, target_p = [], [], [], [], []
-    source_inter, target_inter, way_id = [], [], []
-    for w in ways.values():
-        for i in range(len(w['nodes']) - 1):
-            s = w['nodes'][i]
-            t = w['nodes'][i+1]
-            sp = Point(nodes[s]['lon'], nodes[s]['lat'])
-            tp = Point(nodes[t]['lon'], nodes[t]['lat'])
-            geom.append(LineString((sp, tp)))
-            source.append(s)
-            target.append(t)
-            source_p.append(sp)
-            target_p.append(tp)
-            source_inter.append(len(node_count[s]) > 1)
-            target_inter.append(len(node_count[t]) > 1)
-            way_id.append(w['id'])
-    df =  gpd.GeoDataFrame({'geometry': geom,
-                            'source': source,
-                            'target': target,
-                            'source_p': source_p,
-                            'target_p': target_p,
-                            'source_inter': source_inter,
-                            'target_inter': target_inter,
-                            'way_id': way_id,
-                            'id': np.arange(len(geom), dtype=np.int32)})
+    # node coordinates, sorted by node id
+    node_ids, first = np.unique(np.asarray(node_ids, dtype=np.int64),
+                                return_index=True)
+    coords = np.column_stack((np.asarray(lon)[first], np.asarray(lat)[first]))
+    # one segment per pair of consecutive nodes of a way
+    lengths = np.fromiter((len(w['nodes']) for w in ways.values()),
+                          dtype=np.int64, count=len(ways))
+    way_nodes = np.fromiter(itertools.chain.from_iterable(
+                                w['nodes'] for w in ways.values()),
+                            dtype=np.int64, count=lengths.sum())
+    is_source = np.ones(len(way_nodes), dtype=bool)
+    is_source[np.cumsum(lengths)[lengths > 0] - 1] = False
+    source_i = np.flatnonzero(is_source)
+    source, target = way_nodes[source_i], way_nodes[source_i + 1]
+    way_id = np.repeat(np.fromiter((w['id'] for w in ways.values()),
+                                   dtype=np.int64, count=len(ways)),
+                       np.maximum(lengths - 1, 0))
+    source_xy, target_xy = _lookup(coords, node_ids, source), \
+                           _lookup(coords, node_ids, target)
+    inter = np.fromiter((n for n, w in node_count.items() if len(w) > 1),
+                        dtype=np.int64)
+    columns = {'source': source,
+               'target': target,
+               'source_lon': source_xy[:, 0],
+               'source_lat': source_xy[:, 1],
+               'target_lon': target_xy[:, 0],
+               'target_lat': target_xy[:, 1],
+               'source_inter': np.isin(source, inter),
+               'target_inter': np.isin(target, inter),
+               'way_id': way_id,
+               'id': np.arange(len(source), dtype=np.int32)}
+    if geometry:
+        df = gpd.GeoDataFrame(columns, geometry=shapely.linestrings(
+                                  np.stack((source_xy, target_xy), axis=1)))
+        df['source_p'] = shapely.points(source_xy)
+        df['target_p'] = shapely.points(target_xy)
+    else:
+        df = pd.DataFrame(columns)
     df.set_index('id', drop=False, inplace=True)
     return df
+
@@ -0,0 +1,54 @@
+import math
+
+from .tiles import DEFAULT_TILE_SIZE, tile_bounds, tiles_for_bounds
+from pipeline.imports import lazy_import, LazyObject
+np = lazy_import('numpy')
+shapely = lazy_import('shapely')
+pyproj = lazy_import('pyproj')
+
+
+GEOD = LazyObject(lambda: pyproj.Geod(ellps='WGS84'))
+METERS_PER_DEGREE = 111320.
+
+
+def corridor(geometries, distance):
+    """Returns the area within `distance` meters of `geometries` (lon/lat) as
+      a single (Multi)Polygon, which covers separate clusters of geometries
+      without the space in between.
+      The distance is converted to degrees at the latitude farthest from the
+      equator, so the corridor is never narrower than `distance`.
+    """
+    geometries = np.asarray(geometries)
+    geometries = geometries[~shapely.is_empty(geometries)]
+    if len(geometries) == 0:
+        raise ValueError('No geometries to build a corridor around.')
+    bounds = shapely.total_bounds(geometries)
+    lat = min(max(abs(bounds[1]), abs(bounds[3])), 89.)
+    radius = distance / (METERS_PER_DEGREE * math.cos(math.radians(lat)))
+    area = shapely.union_all(shapely.buffer(geometries, radius, quad_segs=4))
+    shapely.prepare(area)
+    return area
+
+
+def intersecting(area, bounds):
+    """Returns a boolean mask of the bounds in `bounds` which intersect `area`."""
+    if len(bounds) == 0:
+        return np.zeros(0, dtype=bool)
+    return shapely.intersects(area, shapely.box(*np.asarray(bounds).T))
+
+
+def tiles_for_area(area, size=DEFAULT_TILE_SIZE):
+    """Returns all tiles which intersect `area`."""
+    tiles = tiles_for_bounds(area.bounds, size)
+    mask = intersecting(area, [tile_bounds(t, size) for t in tiles])
+    return [t for t, m in zip(tiles, mask) if m]
+
+
+def contains(area, lon, lat):
+    """Returns a boolean mask of the coordinates within (or on) `area`."""
+    return shapely.intersects_xy(area, lon, lat)
+
+
+def area_km2(geometry):
+    """Returns the geodesic area of a lon/lat (Multi)Polygon in km²."""
+    return abs(GEOD.geometry_area_perimeter(geometry)[0]) / 1e6
@@ -0,0 +1,144 @@
+import time
+import queue
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+
+# Responses with these status codes are retried
+RETRY_STATUS = (429, 500, 502, 503, 504)
+DEFAULT_RETRIES = 3
+BACKOFF_BASE = 1.
+BACKOFF_MAX = 60.
+# Seconds until the next endpoint is queried as well
+DEFAULT_HEDGE_AFTER = 10.
+# Weight of the latest request in the moving averages
+SMOOTHING = 0.3
+# Endpoints failing at most this share of requests are preferred to untried ones
+GOOD_ERROR_RATE = 0.5
+
+
+class EndpointStats(object):
+    """Moving averages of the latency and error rate of one endpoint."""
+    def __init__(self):
+        self.requests = 0
+        self.latency = 0.
+        self.error_rate = 0.
+
+    def update(self, latency, error):
+        if self.requests == 0:
+            self.latency = latency
+            self.error_rate = float(error)
+        else:
+            self.latency += SMOOTHING * (latency - self.latency)
+            self.error_rate += SMOOTHING * (float(error) - self.error_rate)
+        self.requests += 1
+
+    @property
+    def score(self):
+        """Expected latency; endpoints with a lower score are preferred. As
+          failed requests are recorded with at least the request timeout (see
+          `record`), an endpoint which fails fast does not score better.
+        """
+        return self.latency
+
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def record(endpoint, latency, error=False, timeout=0.):
+    """Records the outcome of a request to `endpoint`. A failed request counts
+      as taking at least `timeout` seconds, the time lost until the next
+      endpoint is tried in the worst case.
+    """
+    if error:
+        latency = max(latency, timeout)
+    with _lock:
+        _stats.setdefault(endpoint, EndpointStats()).update(latency, error)
+
+
+def endpoint_stats():
+    """Returns Dict endpoint -> (requests, latency, error rate)."""
+    with _lock:
+        return {e: (s.requests, s.latency, s.error_rate) for e, s in _stats.items()}
+
+
+def _rank_key(stats):
+    if stats is None:
+        return (1, 0.)
+    return (0 if stats.error_rate <= GOOD_ERROR_RATE else 2, stats.score)
+
+
+def rank(endpoints):
+    """Sorts `endpoints` by their score. Endpoints without any requests so far
+      come after those with a good record (see `GOOD_ERROR_RATE`) and before
+      those failing more often, ties keep the given order.
+    """
+    if isinstance(endpoints, str):
+        return [endpoints]
+    with _lock:
+        return sorted(endpoints, key=lambda e: _rank_key(_stats.get(e)))
+
+
+def backoff(attempt, retry_after=None):
+    """Returns the delay (seconds) before retry number `attempt` (from 0).
+      A `Retry-After` header value takes precedence over the exponential
+      backoff with full jitter.
+    """
+    if retry_after:
+        try:
+            return min(float(retry_after), BACKOFF_MAX)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                return min(max(delay, 0.), BACKOFF_MAX)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def hedge(call, endpoints, delay=DEFAULT_HEDGE_AFTER, discard=None):
+    """Returns `call(endpoint)` for the best ranked endpoint. If it fails, or
+      has not returned after `delay` seconds, the next endpoint is called too
+      and the first successful result wins. Results which arrive later are
+      passed to `discard`. If all endpoints fail, the last error is raised.
+    """
+    ranked = rank(endpoints)
+    results = queue.Queue()
+    done = threading.Event()
+    lock = threading.Lock()
+
+    def run(endpoint):
+        try:
+            result = call(endpoint)
+        except Exception as err:
+            results.put((False, err))
+            return
+        with lock:
+            if not done.is_set():
+                results.put((True, result))
+                return
+        if discard:
+            discard(result)
+
+    started, failed = 0, 0
+    while True:
+        if started == failed:
+            # nothing in flight (anymore), call the next endpoint right away
+            if started == len(ranked):
+                raise error
+            threading.Thread(target=run, args=(ranked[started],), daemon=True).start()
+            started += 1
+        try:
+            wait = delay if started < len(ranked) else None
+            ok, value = results.get(timeout=wait)
+        except queue.Empty:
+            threading.Thread(target=run, args=(ranked[started],), daemon=True).start()
+            started += 1
+            continue
+        if ok:
+            with lock:
+                done.set()
+            return value
+        failed, error = failed + 1, value
@@ -0,0 +1,216 @@
+import os
+import bz2
+import gzip
+import json
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+
+from .query_overpass import is_road
+from .tiles import DEFAULT_TILE_SIZE, tile_of, tiles_for_bounds, in_bounds
+from .corridor import contains, tiles_for_area
+
+
+INDEX_META = 'index.json'
+
+
+def _open(path):
+    """Opens a (optionally compressed) OSM XML file in binary mode."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def _iter_xml(path):
+    """Yields the nodes and ways of an OSM XML file in Overpass JSON format."""
+    with _open(path) as fp:
+        root = None
+        for event, elem in ET.iterparse(fp, events=('start', 'end')):
+            if root is None:
+                root = elem
+            if event != 'end':
+                continue
+            if elem.tag == 'node':
+                yield {'type': 'node',
+                       'id': int(elem.get('id')),
+                       'lat': float(elem.get('lat')),
+                       'lon': float(elem.get('lon'))}
+            elif elem.tag == 'way':
+                yield {'type': 'way',
+                       'id': int(elem.get('id')),
+                       'nodes': [int(nd.get('ref')) for nd in elem.iter('nd')],
+                       'tags': {t.get('k'): t.get('v') for t in elem.iter('tag')}}
+            elif elem.tag != 'relation':
+                continue
+            # processed elements are not needed anymore
+            root.clear()
+
+
+def _iter_pbf(path):
+    """Yields the nodes and ways of an OSM PBF file in Overpass JSON format."""
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError('Reading PBF files requires the package `osmium`.')
+    for obj in osmium.FileProcessor(path, osmium.osm.NODE | osmium.osm.WAY):
+        if obj.is_node():
+            yield {'type': 'node',
+                   'id': obj.id,
+                   'lat': obj.location.lat,
+                   'lon': obj.location.lon}
+        else:
+            yield {'type': 'way',
+                   'id': obj.id,
+                   'nodes': [n.ref for n in obj.nodes],
+                   'tags': {t.k: t.v for t in obj.tags}}
+
+
+def iter_extract(path):
+    """Streams the nodes and ways of a local OSM extract (XML or PBF)."""
+    if path.endswith('.pbf'):
+        return _iter_pbf(path)
+    return _iter_xml(path)
+
+
+def _read_nodes(path, ids):
+    """Returns the coordinates of all nodes in `ids` as Dict id -> (lon, lat).
+      Extracts are sorted by convention (nodes before ways), so reading stops
+      at the first way.
+    """
+    coords = {}
+    for obj in iter_extract(path):
+        if obj['type'] != 'node':
+            break
+        if obj['id'] in ids:
+            coords[obj['id']] = (obj['lon'], obj['lat'])
+    return coords
+
+
+def _clip(nodes, coords):
+    """Returns the longest run of consecutive `nodes` with coordinates. Roads
+      of clipped extracts reference nodes outside the extract, which are
+      missing; such a road ends at its last node within the extract.
+    """
+    best, run = [], []
+    for n in nodes:
+        if n in coords:
+            run.append(n)
+            if len(run) > len(best):
+                best = run
+        else:
+            run = []
+    return best
+
+
+def _to_elements(ways, coords):
+    """Returns OSM data in Overpass JSON format, as understood by `load_osm`."""
+    nodes = [{'type': 'node', 'id': id, 'lon': lon, 'lat': lat}
+             for id, (lon, lat) in coords.items()]
+    ways = [{'type': 'way', 'id': w['id'], 'nodes': _clip(w['nodes'], coords)}
+            for w in ways]
+    return {'elements': nodes + [w for w in ways if len(w['nodes']) > 1]}
+
+
+def _in_area(coords, area):
+    """Returns the ids in `coords` (Dict id -> (lon, lat)) within `area`."""
+    if area is None:
+        return set(coords)
+    ids = list(coords)
+    lon, lat = zip(*[coords[n] for n in ids]) if ids else ((), ())
+    return set([n for n, m in zip(ids, contains(area, lon, lat)) if m])
+
+
+def read_extract(path, bounds, area=None):
+    """Reads the street network within `bounds` from a local OSM extract.
+      The same streets as in `query_overpass` are selected: all ways passing
+      the blacklists with at least one node within `bounds`, plus all nodes
+      of those ways. The extract is streamed twice and only the selected
+      elements are kept in memory.
+      Arguments:
+        path: String. Path to an OSM XML (optionally .gz/.bz2) or PBF file.
+        bounds: Tuple. (minx, miny, maxx, maxy) in lon/lat.
+        area: Shapely geometry or None. If given, only streets with at least
+          one node within `bounds` and `area` are selected.
+      Returns:
+        Dict. The OSM data in JSON format (see `osm.convert.load_osm`).
+    """
+    inside, ways = {}, []
+    for obj in iter_extract(path):
+        if obj['type'] == 'node':
+            if in_bounds(obj['lon'], obj['lat'], bounds):
+                inside[obj['id']] = (obj['lon'], obj['lat'])
+        elif is_road(obj['tags']) and any(n in inside for n in obj['nodes']):
+            ways.append(obj)
+    inside = _in_area(inside, area)
+    ways = [w for w in ways if any(n in inside for n in w['nodes'])]
+    ids = set([n for w in ways for n in w['nodes']])
+    return _to_elements(ways, _read_nodes(path, ids))
+
+
+def build_extract_index(path, index, tile_size=DEFAULT_TILE_SIZE):
+    """Splits the streets of a local OSM extract into tiles, once per region.
+      Each tile is stored as compressed JSON in the directory `index` and
+      contains all streets with at least one node within the tile.
+      Subsequent calls of `query_extract` only read the tiles they need.
+    """
+    ways, ids = [], set()
+    for obj in iter_extract(path):
+        if obj['type'] == 'way' and is_road(obj['tags']):
+            ways.append({'id': obj['id'], 'nodes': obj['nodes']})
+            ids.update(obj['nodes'])
+    # clipped extracts lack the nodes of roads leaving the region
+    coords = _read_nodes(path, ids)
+    tiles = defaultdict(list)
+    for w in ways:
+        for tile in set(tile_of(*coords[n], size=tile_size)
+                        for n in w['nodes'] if n in coords):
+            tiles[tile].append(w)
+    if not os.path.isdir(index):
+        os.makedirs(index)
+    for (x, y), tile_ways in tiles.items():
+        tile_coords = {n: coords[n] for w in tile_ways for n in w['nodes']
+                       if n in coords}
+        with gzip.open(os.path.join(index, '%d_%d.json.gz' % (x, y)), 'wt') as fp:
+            json.dump(_to_elements(tile_ways, tile_coords), fp)
+    with open(os.path.join(index, INDEX_META), 'w') as fp:
+        json.dump({'source': os.path.basename(path), 'tile_size': tile_size}, fp)
+
+
+def query_extract(bounds, index, area=None):
+    """Reads the street network within `bounds` (and `area`) from a tiled
+      extract index (see `build_extract_index`). Returns the same as
+      `read_extract`.
+    """
+    with open(os.path.join(index, INDEX_META), 'r') as fp:
+        tile_size = json.load(fp)['tile_size']
+    tiles = tiles_for_bounds(bounds, tile_size)
+    if area is not None:
+        tiles = sorted(set(tiles) & set(tiles_for_area(area, tile_size)))
+    ways, coords = {}, {}
+    for x, y in tiles:
+        path = os.path.join(index, '%d_%d.json.gz' % (x, y))
+        if not os.path.exists(path):
+            continue
+        with gzip.open(path, 'rt') as fp:
+            data = json.load(fp)
+        for obj in data['elements']:
+            if obj['type'] == 'node':
+                coords[obj['id']] = (obj['lon'], obj['lat'])
+            else:
+                ways[obj['id']] = obj
+    inside = _in_area({n: c for n, c in coords.items()
+                       if in_bounds(*c, bounds=bounds)}, area)
+    ways = [w for w in ways.values() if any(n in inside for n in w['nodes'])]
+    return _to_elements(ways, {n: coords[n] for w in ways for n in w['nodes']
+                               if n in coords})
+
+
+def load_extract(extract, bounds, area=None):
+    """Reads the street network within `bounds` (and `area`) from `extract`,
+      which is either a tiled index directory or the path to a local OSM
+      extract.
+    """
+    if os.path.isdir(extract):
+        return query_extract(bounds, extract, area)
+    return read_extract(extract, bounds, area)
@@ -1,13 +1,34 @@
-import os
-import json
-import requests
-import urllib3
-urllib3.disable_warnings() # Suppresses InsecureRequestWarning
+import time
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from contextlib import ExitStack
+
+from .cache import DEFAULT_TTL, DEFAULT_MAX_SIZE, tile_path, is_fresh, touch, \
+                   lock, evict, in_use
+from .convert import merge_elements, write_elements
+from .corridor import intersecting, tiles_for_area
+from .endpoints import DEFAULT_RETRIES, DEFAULT_HEDGE_AFTER, RETRY_STATUS, \
+                       record, backoff, hedge
+from .tiles import DEFAULT_TILE_SIZE, tile_bounds, tiles_for_bounds, \
+                   split_bounds, subdivide
+from pipeline.imports import lazy_import
+requests = lazy_import('requests')
+urllib3 = lazy_import('urllib3')
 
 
 DEFAULT_ENDPOINT = 'https://overpass-api.de/api/interpreter'
 DEFAULT_TIMEOUT = 25
+DEFAULT_WORKERS = 4
+MAX_SUBDIVISIONS = 3
 PATH_CACHE = '.tmp'
+# Overpass reports runtime errors (e.g. timeouts) at the end of a response
+REMARK_SIZE = 1024
+
+
+class QueryAborted(ValueError):
+    """Overpass aborted a query, e.g. as it ran out of time or memory."""
 
 
 ################################################################################
@@ -23,14 +44,61 @@ blacklist_access = ['no', 'private', 'delivery', 'agricultural', 'forestry']
 ################################################################################
 
 
-def overpass_post(query, endpoint, timeout):
+def is_road(tags):
+    """Returns True if a way with the given tags is selected by `build_query`."""
+    return 'highway' in tags and 'area' not in tags and \
+           tags['highway'] not in blacklist_highway and \
+           tags.get('service') not in blacklist_service and \
+           tags.get('access') not in blacklist_access
+
+
+def make_session(workers=DEFAULT_WORKERS):
+    """Returns a session which keeps up to `workers` connections alive."""
+    urllib3.disable_warnings() # Suppresses InsecureRequestWarning
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                                            pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def overpass_post(query, endpoint, timeout, stream=False, session=None,
+                  retries=DEFAULT_RETRIES):
+    """Posts `query` to `endpoint`. Failed connections and responses with a
+      status in `RETRY_STATUS` (rate limits, overloaded servers) are retried
+      up to `retries` times, after a jittered backoff or as long as the server
+      asks for via `Retry-After`. The latency and errors of each request are
+      recorded for the endpoint selection (see `osm.endpoints.rank`).
+    """
     payload = {'data': query}
-    r = requests.post(endpoint,
-                      data=payload,
-                      timeout=timeout,
-                      verify=False)
-    if r.status_code != 200:
-        raise ValueError('Unable to retrieve data. Status code: %d.' % r.status_code)
+    for attempt in range(retries + 1):
+        start = time.time()
+        try:
+            r = (session or requests).post(endpoint,
+                                           data=payload,
+                                           timeout=timeout,
+                                           verify=False,
+                                           stream=stream)
+        except requests.RequestException as err:
+            record(endpoint, time.time() - start, error=True, timeout=timeout)
+            # a query which times out is split instead (see `fetch_tiles`)
+            if not isinstance(err, requests.ConnectionError) or attempt == retries:
+                raise
+            time.sleep(backoff(attempt))
+            continue
+        if r.status_code == 200:
+            record(endpoint, time.time() - start)
+            break
+        record(endpoint, time.time() - start, error=True, timeout=timeout)
+        r.close()
+        if r.status_code not in RETRY_STATUS or attempt == retries:
+            raise ValueError('Unable to retrieve data. Status code: %d.' % r.status_code)
+        time.sleep(backoff(attempt, r.headers.get('Retry-After')))
+    if stream:
+        # the body as a file object, decompressed while reading
+        r.raw.decode_content = True
+        return r.raw
     return r.json()
 
 
@@ -49,21 +117,184 @@ def build_query(bounds):
     return '[out:json];(' + nodes + ways + ');out body;>;out body qt;'
 
 
-def make_filename(bounds):
-    if not isinstance(bounds, tuple) or len(bounds) != 4:
-        raise ValueError('`bounds` has to be a tuple of exactly 4 numbers.')
-    return 'osm_{y1}.{x1}.{y2}.{x2}.json'.format(x1=bounds[0], y1=bounds[1],
-                                                 x2=bounds[2], y2=bounds[3])
+def _download(bounds, endpoint, timeout, session):
+    """Downloads the streets within `bounds` into a temporary file."""
+    body = overpass_post(build_query(bounds), endpoint, timeout,
+                         stream=True, session=session)
+    fp = tempfile.TemporaryFile()
+    shutil.copyfileobj(body, fp)
+    fp.seek(max(fp.tell() - REMARK_SIZE, 0))
+    if b'runtime error' in fp.read():
+        fp.close()
+        raise QueryAborted('Overpass aborted the query for %s.' % (bounds,))
+    fp.seek(0)
+    return fp
+
+
+def _too_large(err):
+    """Returns True if `err` is a timeout or an aborted query, which smaller
+      parts of the query might avoid.
+    """
+    return isinstance(err, (QueryAborted, requests.ReadTimeout,
+                            urllib3.exceptions.ReadTimeoutError))
+
+
+def _fetch_tile(bounds, endpoint, timeout, session, hedge_after):
+    """Downloads the streets within `bounds` from the best of the endpoints,
+      hedged by the next ones if it is slow or fails (see `osm.endpoints.hedge`).
+    """
+    return hedge(lambda e: _download(bounds, e, timeout, session),
+                 endpoint, hedge_after, discard=lambda fp: fp.close())
+
+
+def fetch_tiles(tiles, endpoint=DEFAULT_ENDPOINT,
+                       timeout=DEFAULT_TIMEOUT,
+                       workers=DEFAULT_WORKERS,
+                       max_subdivisions=MAX_SUBDIVISIONS,
+                       hedge_after=DEFAULT_HEDGE_AFTER):
+    """Queries the streets within each bounds in `tiles` concurrently.
+      At most `workers` tiles are fetched in parallel, sharing pooled keep-alive
+      connections. `endpoint` is an Overpass URL or a list of mirrors; a tile
+      which is not answered within `hedge_after` seconds is requested from the
+      next mirror as well. A tile whose request times out or is aborted by
+      Overpass on all mirrors is split into four quarters, which are queried
+      instead (up to `max_subdivisions` times). Other errors, e.g. rate limits
+      which persist after the retries of `overpass_post`, are raised.
+      Returns:
+        List. For each tile, a list of file objects with the raw Overpass
+          responses of the tile (or of its parts, if it was subdivided).
+    """
+    n = 1 if isinstance(endpoint, str) else len(endpoint)
+    session = make_session(workers * n)
+    pending, results = {}, {}
+    error = None
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            def submit(bounds, key):
+                future = executor.submit(_fetch_tile, bounds, endpoint, timeout,
+                                         session, hedge_after)
+                pending[future] = (bounds, key)
+            for i, bounds in enumerate(tiles):
+                submit(bounds, (i,))
+            while pending and error is None:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    bounds, key = pending.pop(future)
+                    try:
+                        results[key] = future.result()
+                    except Exception as err:
+                        if not _too_large(err) or len(key) > max_subdivisions:
+                            error = err
+                            for f in pending:
+                                f.cancel()
+                            break
+                        for j, quarter in enumerate(subdivide(bounds)):
+                            submit(quarter, key + (j,))
+    finally:
+        session.close()
+    if error is not None:
+        # running futures are not cancelled, the executor waited for them
+        for f in pending:
+            if not f.cancelled() and f.exception() is None:
+                f.result().close()
+        for fp in results.values():
+            fp.close()
+        raise error
+    tiles = [[] for _ in tiles]
+    for key in sorted(results):
+        tiles[key[0]].append(results[key])
+    return tiles
+
+
+def _close(responses):
+    for files in responses:
+        for fp in files:
+            fp.close()
+
+
+def query_tiles(bounds, tile_size=DEFAULT_TILE_SIZE, area=None):
+    """Returns the tiles `query_overpass` loads for `bounds` and `area`."""
+    tiles = tiles_for_bounds(bounds, tile_size)
+    if area is not None:
+        tiles = sorted(set(tiles) & set(tiles_for_area(area, tile_size)))
+    return tiles
+
+
+def query_bounds(bounds, cache=PATH_CACHE, tile_size=DEFAULT_TILE_SIZE,
+                 area=None):
+    """Returns the bounds `query_overpass` loads all streets within: whole
+      tiles with a `cache`, else the parts of `bounds` within each tile.
+    """
+    if cache:
+        return [tile_bounds(t, tile_size)
+                for t in query_tiles(bounds, tile_size, area)]
+    parts = split_bounds(bounds, tile_size)
+    if area is not None:
+        parts = [p for p, m in zip(parts, intersecting(area, parts)) if m]
+    return parts
 
 
 def query_overpass(bounds, cache=PATH_CACHE,
                            endpoint=DEFAULT_ENDPOINT,
-                           timeout=DEFAULT_TIMEOUT):
-    if cache and not os.path.isdir(cache):
-        os.mkdir(cache)
-    if cache and os.path.exists(os.path.join(cache, make_filename(bounds))):
-        return json.load(open(os.path.join(cache, make_filename(bounds)), 'r'))
-    map = overpass_post(build_query(bounds), endpoint, timeout)
-    if cache:
-        json.dump(map, open(os.path.join(cache, make_filename(bounds)), 'w'))
-    return map
+                           timeout=DEFAULT_TIMEOUT,
+                           parse=True,
+                           tile_size=DEFAULT_TILE_SIZE,
+                           workers=DEFAULT_WORKERS,
+                           ttl=DEFAULT_TTL,
+                           max_size=DEFAULT_MAX_SIZE,
+                           hedge_after=DEFAULT_HEDGE_AFTER,
+                           area=None):
+    """Queries the street network within `bounds` from Overpass.
+      The network is fetched in tiles of the tile grid (`tile_size` degrees),
+      concurrently (see `fetch_tiles`). Each tile is cached as compressed JSON,
+      so that later queries overlapping the same tiles do not fetch them again,
+      unless they are older than `ttl` seconds. Tiles are locked while they are
+      fetched; concurrent jobs wait for each other instead of fetching the same
+      tile twice. Once the cache grows beyond `max_size` bytes, the least
+      recently used files are deleted. Without `cache`, only `bounds` itself is
+      fetched, split along the tile grid. `endpoint` may be a list of mirrors,
+      which are used depending on their latency and errors so far. If `area`
+      (a shapely geometry, e.g. `osm.corridor.corridor`) is given, only the
+      tiles within `bounds` which intersect `area` are fetched.
+      Returns:
+        If `parse` is True, a Dict with the merged elements of all tiles
+        without duplicates. Otherwise, the paths of the cached tiles (or the
+        responses as file objects if `cache` is None), which can be streamed
+        by `osm.convert.load_osm`.
+    """
+    if not cache:
+        parts = query_bounds(bounds, cache, tile_size, area)
+        responses = fetch_tiles(parts, endpoint,
+                                timeout, workers, hedge_after=hedge_after)
+        files = [fp for files in responses for fp in files]
+        if not parse:
+            return files
+        data = {'elements': list(merge_elements(files))}
+        _close(responses)
+        return data
+    # the tiles must not be evicted by other jobs until they are read
+    with in_use(cache):
+        tiles = query_tiles(bounds, tile_size, area)
+        paths = [tile_path(cache, tile, tile_size) for tile in tiles]
+        missing = sorted([(p, t) for p, t in zip(paths, tiles)
+                          if not is_fresh(p, ttl)])
+        if missing:
+            with ExitStack() as stack:
+                for p, _ in missing:
+                    stack.enter_context(lock(p))
+                # other jobs might have fetched some tiles in the meantime
+                missing = [(p, t) for p, t in missing
+                           if not is_fresh(p, ttl)]
+                responses = fetch_tiles([tile_bounds(t, tile_size)
+                                         for _, t in missing],
+                                        endpoint, timeout, workers,
+                                        hedge_after=hedge_after)
+                for (p, _), files in zip(missing, responses):
+                    write_elements(merge_elements(files), p)
+                _close(responses)
+        for p in paths:
+            touch(p)
+        evict(cache, max_size, keep=paths)
+        if parse:
+            return {'elements': list(merge_elements(paths))}
+        return paths
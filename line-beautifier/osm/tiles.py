@@ -0,0 +1,51 @@
+import math
+
+
+# Edge length of the tiles in degrees
+DEFAULT_TILE_SIZE = 0.05
+
+
+def tile_of(lon, lat, size=DEFAULT_TILE_SIZE):
+    """Returns the tile (x, y) which contains the given coordinate."""
+    return int(math.floor(lon / size)), int(math.floor(lat / size))
+
+
+def tile_bounds(tile, size=DEFAULT_TILE_SIZE):
+    """Returns the bounds (minx, miny, maxx, maxy) of the given tile."""
+    return (round(tile[0] * size, 9), round(tile[1] * size, 9),
+            round((tile[0] + 1) * size, 9), round((tile[1] + 1) * size, 9))
+
+
+def tiles_for_bounds(bounds, size=DEFAULT_TILE_SIZE):
+    """Returns all tiles which intersect `bounds` (minx, miny, maxx, maxy)."""
+    x1, y1 = tile_of(bounds[0], bounds[1], size)
+    x2, y2 = tile_of(bounds[2], bounds[3], size)
+    return [(x, y) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)]
+
+
+def in_bounds(lon, lat, bounds):
+    """Returns True if the coordinate lies within `bounds`."""
+    return bounds[0] <= lon <= bounds[2] and bounds[1] <= lat <= bounds[3]
+
+
+def split_bounds(bounds, size=DEFAULT_TILE_SIZE):
+    """Splits `bounds` along the tile grid; each part lies within one tile."""
+    parts = []
+    for tile in tiles_for_bounds(bounds, size):
+        tb = tile_bounds(tile, size)
+        part = (max(bounds[0], tb[0]), max(bounds[1], tb[1]),
+                min(bounds[2], tb[2]), min(bounds[3], tb[3]))
+        # skip slivers where `bounds` ends exactly on a tile border
+        if (part[0] == part[2] and bounds[0] < bounds[2]) or \
+           (part[1] == part[3] and bounds[1] < bounds[3]):
+            continue
+        parts.append(part)
+    return parts
+
+
+def subdivide(bounds):
+    """Splits `bounds` into four quarters."""
+    x1, y1, x2, y2 = bounds
+    xm, ym = (x1 + x2) / 2., (y1 + y2) / 2.
+    return [(x1, y1, xm, ym), (xm, y1, x2, ym),
+            (x1, ym, xm, y2), (xm, ym, x2, y2)]
@@ -0,0 +1,108 @@
+import os
+import time
+import pickle
+import hashlib
+
+
+# Records are written to disk at least this often (seconds)
+DEFAULT_INTERVAL = 30.
+
+
+def checkpoint_path(path_out):
+    """Returns the location of the checkpoint of output file `path_out`."""
+    return path_out + '.checkpoint'
+
+
+class Checkpoint(object):
+    """Append-only file of finished work, e.g. the matched path of each
+      LineString and the optimized GeoDataFrame of each batch, so that an
+      interrupted run can resume where it stopped.
+      Each record is a pickled tuple (key, value), see `key`. Records are
+      buffered and written every `interval` seconds (or on `flush`). A record
+      cut off by a crash is dropped, together with anything after it. Only
+      the offsets of written records are kept in memory, their values are
+      read from disk when they are looked up.
+      Arguments:
+        path: String. Location of the checkpoint (see `checkpoint_path`).
+        resume: Boolean. Whether to keep the records of an existing
+          checkpoint. If False, the checkpoint starts empty.
+        interval: Float. Seconds between writes of buffered records.
+    """
+    def __init__(self, path, resume=False, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.offsets = {}
+        self.buffer = {}
+        offset = self._read() if resume and os.path.exists(path) else 0
+        self.fp = open(path, 'r+b' if offset else 'wb')
+        self.fp.seek(offset)
+        self.fp.truncate()
+        self.reader = None
+        self.written = time.time()
+
+    def _read(self):
+        """Finds all complete records, returns the offset after the last one."""
+        offset = 0
+        with open(self.path, 'rb') as fp:
+            while True:
+                try:
+                    key, _ = pickle.load(fp)
+                except Exception:
+                    # end of file, or the last record was not written completely
+                    break
+                self.offsets[key] = offset
+                offset = fp.tell()
+        return offset
+
+    @staticmethod
+    def key(*values):
+        """Returns the key of a record, which changes whenever one of `values`
+          (bytes or values with a stable `repr`) does.
+        """
+        h = hashlib.sha1()
+        for value in values:
+            h.update(value if isinstance(value, bytes) else repr(value).encode())
+            h.update(b'\0')
+        return h.digest()
+
+    def __contains__(self, key):
+        return key in self.buffer or key in self.offsets
+
+    def __getitem__(self, key):
+        if key in self.buffer:
+            return self.buffer[key]
+        offset = self.offsets[key]
+        if self.reader is None:
+            self.reader = open(self.path, 'rb')
+        self.reader.seek(offset)
+        return pickle.load(self.reader)[1]
+
+    def add(self, key, value):
+        """Records `value`, written with the next flush."""
+        self.buffer[key] = value
+        if time.time() - self.written >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Writes all buffered records to disk, which are then dropped from
+          memory.
+        """
+        for record in self.buffer.items():
+            self.offsets[record[0]] = self.fp.tell()
+            pickle.dump(record, self.fp, protocol=pickle.HIGHEST_PROTOCOL)
+        self.buffer = {}
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.written = time.time()
+
+    def close(self, remove=False):
+        """Flushes and closes the checkpoint. With `remove`, e.g. once the
+          output is complete, the checkpoint is deleted instead.
+        """
+        if not remove:
+            self.flush()
+        self.fp.close()
+        if self.reader is not None:
+            self.reader.close()
+        if remove and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,66 @@
+import sys
+import time
+import types
+import importlib
+
+
+# Lazily imported modules in load order: (name, seconds, module using it first)
+IMPORT_TIMES = []
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for module `name` until one of its attributes is used, which
+      imports the module. Its attributes are then copied, so later lookups
+      are as fast as on the module itself.
+    """
+    def __getattr__(self, attr):
+        name = self.__name__
+        if name not in sys.modules:
+            start = time.perf_counter()
+            importlib.import_module(name)
+            IMPORT_TIMES.append((name, time.perf_counter() - start,
+                                 sys._getframe(1).f_globals.get('__name__')))
+        module = sys.modules[name]
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """Returns module `name`, which is only imported once it is used, e.g.
+      `np = lazy_import('numpy')` instead of `import numpy as np`. Modules
+      which are already imported are returned as they are.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
+class LazyObject(object):
+    """Stands in for the object returned by `factory`, which is only called
+      once an attribute is used, e.g. for module level objects of lazily
+      imported modules. Methods are looked up only once.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._object = None
+
+    def __getattr__(self, attr):
+        if self._object is None:
+            self._object = self._factory()
+        value = getattr(self._object, attr)
+        if callable(value):
+            setattr(self, attr, value)
+        return value
+
+
+def report_imports(started, file=sys.stderr):
+    """Prints the seconds since `started` (`time.perf_counter`) and the time
+      each lazily imported module took to load, the slowest first. Modules
+      imported by a module are included in its time.
+    """
+    print('Total: %.3f s, lazy imports: %.3f s'
+          % (time.perf_counter() - started,
+             sum(t for _, t, _ in IMPORT_TIMES)), file=file)
+    for name, seconds, user in sorted(IMPORT_TIMES, key=lambda i: -i[1]):
+        print('  %-24s %.3f s (first used by %s)' % (name, seconds, user),
+              file=file)
@@ -0,0 +1,132 @@
+import os
+import pickle
+import hashlib
+
+from osm.cache import DEFAULT_MAX_SIZE, is_fresh, touch, evict, in_use
+from .imports import lazy_import
+shapely = lazy_import('shapely')
+pd = lazy_import('pandas')
+
+
+def frame_key(df):
+    """Returns a key of the geometries and index of GeoDataFrame `df`."""
+    h = hashlib.sha1()
+    for wkb in shapely.to_wkb(df.geometry.values):
+        h.update(wkb)
+    h.update(pd.util.hash_pandas_object(df.index).values.tobytes())
+    return h.hexdigest()
+
+
+class Stage(object):
+    """A step of a `Pipeline`, see `Pipeline.add`."""
+    def __init__(self, function, inputs=(), params=None, key=None,
+                 cached=True, ttl=None):
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.params = params or {}
+        self.key = key
+        self.cached = cached
+        self.ttl = ttl
+
+
+class Pipeline(object):
+    """Runs stages which depend on each other's outputs (a DAG), caching the
+      outputs on disk in `cache`/stages.
+      Each stage is keyed by its name, parameters and `key` and by the keys of
+      the stages it depends on, so the key changes whenever anything the
+      output is computed from does. A stage is only executed if its output
+      is not cached under its key; the stages before it are then not needed
+      at all. Changing a parameter thus only re-executes the stages from the
+      first one which uses it. Cached outputs are evicted together with the
+      OSM data in `cache` (least recently used first, see `osm.cache`).
+      Arguments:
+        cache: String or None. Cache directory. If None, nothing is cached.
+        max_size: Int. Maximum size of `cache` in bytes.
+        verbose: Boolean. Whether to print which stages are taken from the
+          cache.
+    """
+    def __init__(self, cache=None, max_size=DEFAULT_MAX_SIZE, verbose=False):
+        self.cache = cache
+        self.max_size = max_size
+        self.verbose = verbose
+        self.stages = {}
+        self.keys = {}
+        self.outputs = {}
+
+    def add(self, name, function, inputs=(), params=None, key=None,
+            cached=True, ttl=None):
+        """Adds stage `name`, which returns `function(*outputs, **params)` with
+          the `outputs` of the stages `inputs`.
+          Arguments:
+            params: Dict or None. Parameters of the stage, part of its key
+              (by `repr`). Arguments which do not change the output (e.g.
+              number of processes) are bound to `function` instead.
+            key: Object or None. Part of the key for data the stage reads
+              other than its inputs, e.g. a key of the input geometries.
+            cached: Boolean. Whether the output is cached. Stages which are
+              faster to run than to load should not be.
+            ttl: Float or None. Seconds after which a cached output is
+              computed again, e.g. if it depends on downloaded data. If None,
+              it stays valid as long as it is cached.
+        """
+        self.stages[name] = Stage(function, inputs, params, key, cached, ttl)
+        self.keys.pop(name, None)
+        self.outputs.pop(name, None)
+
+    def key(self, name):
+        """Returns the key of stage `name`."""
+        if name not in self.keys:
+            stage = self.stages[name]
+            h = hashlib.sha1(name.encode())
+            h.update(repr((stage.key, sorted(stage.params.items()))).encode())
+            for input in stage.inputs:
+                h.update(self.key(input).encode())
+            self.keys[name] = h.hexdigest()
+        return self.keys[name]
+
+    def path(self, name):
+        """Returns the location of the cached output of stage `name`."""
+        return os.path.join(self.cache, 'stages',
+                            '%s_%s.pkl' % (name, self.key(name)))
+
+    def _load(self, path):
+        touch(path)
+        with open(path, 'rb') as fp:
+            return pickle.load(fp)
+
+    def _store(self, path, output):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name, so that no process reads a partial file
+        tmp = '%s.%d.part' % (path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            pickle.dump(output, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        evict(self.cache, self.max_size, keep=[path])
+
+    def _cached(self, name, path, ttl):
+        """Returns the cached output at `path`, None if it is not cached."""
+        # other jobs must not evict the output until it is read
+        with in_use(self.cache):
+            if not is_fresh(path, ttl):
+                return None
+            if self.verbose:
+                print('Using cached output of stage "%s"' % name)
+            return self._load(path)
+
+    def run(self, name):
+        """Returns the output of stage `name`, executing it and the stages it
+          depends on only if needed.
+        """
+        if name in self.outputs:
+            return self.outputs[name]
+        stage = self.stages[name]
+        path = self.path(name) if self.cache and stage.cached else None
+        output = self._cached(name, path, stage.ttl) if path else None
+        if output is None:
+            output = stage.function(*[self.run(input) for input in stage.inputs],
+                                    **stage.params)
+            if path:
+                self._store(path, output)
+        self.outputs[name] = output
+        return output
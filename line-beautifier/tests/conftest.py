@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LON, LAT, STEP = 13.40, 52.50, 0.0012
+SIZE = 6
+
+
+def _streets():
+    """A grid of residential streets, SIZE x SIZE crossings."""
+    nodes, ways = {}, []
+    for i in range(SIZE):
+        for j in range(SIZE):
+            nodes[1000 + i * SIZE + j] = (LON + i * STEP, LAT + j * STEP * .66)
+    for k in range(SIZE):
+        ways.append([1000 + k * SIZE + j for j in range(SIZE)])
+        ways.append([1000 + i * SIZE + k for i in range(SIZE)])
+    elements = [{'type': 'node', 'id': id, 'lon': lon, 'lat': lat}
+                for id, (lon, lat) in nodes.items()]
+    elements += [{'type': 'way', 'id': 500 + k, 'nodes': w,
+                  'tags': {'highway': 'residential'}}
+                 for k, w in enumerate(ways)]
+    return {'version': 0.6, 'elements': elements}
+
+
+def trace(i0, j0, i1, j1, n=11, offset=2e-5):
+    """A LineString feature from crossing (i0, j0) to (i1, j1), drawn a
+      little beside the street.
+    """
+    coords = [(LON + (i0 + (i1 - i0) * t / (n - 1.)) * STEP + offset,
+               LAT + (j0 + (j1 - j0) * t / (n - 1.)) * STEP * .66 + offset)
+              for t in range(n)]
+    return {'type': 'Feature', 'properties': {},
+            'geometry': {'type': 'LineString', 'coordinates': coords}}
+
+
+def write_features(path, features):
+    with open(path, 'w') as fp:
+        json.dump({'type': 'FeatureCollection', 'features': features}, fp)
+    return path
+
+
+@pytest.fixture
+def overpass(tmp_path, monkeypatch):
+    """Serves the street grid as if it was queried from Overpass and cached,
+      with the cache in `tmp_path`. Returns the path of the OSM data.
+    """
+    import map_matching.map_matching as mm
+    path = str(tmp_path / 'streets.json')
+    with open(path, 'w') as fp:
+        json.dump(_streets(), fp)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('.tmp')
+    monkeypatch.setattr(mm, 'query_overpass', lambda *args, **kwargs: [path])
+    return path
@@ -0,0 +1,51 @@
+import os
+import multiprocessing
+
+from osm.cache import evict, in_use
+
+
+def _use(cache, ready, done):
+    with in_use(cache):
+        ready.set()
+        done.wait(30)
+
+
+def _files(cache, count=3):
+    paths = [os.path.join(cache, 'tile%d.json.gz' % i) for i in range(count)]
+    for path in paths:
+        with open(path, 'wb') as fp:
+            fp.write(b'x' * 100)
+    return paths
+
+
+def test_evict_skips_caches_used_by_other_processes(tmp_path):
+    cache = str(tmp_path)
+    paths = _files(cache)
+    context = multiprocessing.get_context('fork')
+    ready, done = context.Event(), context.Event()
+    process = context.Process(target=_use, args=(cache, ready, done))
+    process.start()
+    try:
+        assert ready.wait(30)
+        evict(cache, max_size=0)
+        assert all(os.path.exists(p) for p in paths)
+    finally:
+        done.set()
+        process.join()
+    evict(cache, max_size=0, keep=paths[:1])
+    assert [os.path.exists(p) for p in paths] == [True, False, False]
+
+
+def test_evict_while_used_by_this_process(tmp_path):
+    cache = str(tmp_path)
+    paths = _files(cache)
+    with in_use(cache):
+        evict(cache, max_size=0, keep=paths[:1])
+        assert [os.path.exists(p) for p in paths] == [True, False, False]
+        # the cache is still marked as used
+        paths = _files(cache)
+        context = multiprocessing.get_context('fork')
+        process = context.Process(target=evict, args=(cache, 0))
+        process.start()
+        process.join()
+        assert all(os.path.exists(p) for p in paths)
@@ -0,0 +1,78 @@
+import geopandas as gpd
+import pytest
+import shapely
+
+import optimize
+from conftest import trace, write_features
+from geodata.formats import from_arrow, to_arrow, iter_batches, \
+                            read_geolocations, write_geolocations
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+needs_pyarrow = pytest.mark.skipif(pa is None, reason='requires pyarrow')
+
+
+def _frame():
+    return gpd.GeoDataFrame({'name': ['a', 'b'], 'value': [1, 2]},
+                            geometry=[shapely.Point(13.4, 52.5),
+                                      shapely.LineString([(13.4, 52.5),
+                                                          (13.41, 52.51)])],
+                            crs='EPSG:4326')
+
+
+@needs_pyarrow
+def test_arrow_round_trip():
+    df = _frame()
+    table = to_arrow(df)
+    assert table.schema.field('geometry').type == pa.binary()
+    back = from_arrow(table)
+    assert list(back.columns) == ['name', 'value', 'geometry']
+    assert back.geometry.geom_equals_exact(df.geometry, 0).all()
+    assert back['value'].tolist() == [1, 2]
+
+
+@needs_pyarrow
+def test_from_arrow_selects_columns():
+    table = to_arrow(_frame())
+    df = from_arrow(table.to_batches()[0], columns=[])
+    assert list(df.columns) == ['geometry'] and len(df) == 2
+    assert list(from_arrow(table, columns=['name']).columns) == \
+           ['name', 'geometry']
+
+
+@needs_pyarrow
+def test_optimize_data_arrow(overpass, tmp_path):
+    df = gpd.read_file(write_features(str(tmp_path / 'in.geojson'),
+                                      [trace(0, 1, 4, 1), trace(2, 0, 2, 4)]))
+    df['name'] = ['a', 'b']
+    table = pa.table({'name': df['name'].tolist(),
+                      'geom': shapely.to_wkb(df.geometry.values)})
+    expected = optimize.optimize_data(df, verbose=False, stage_cache=None)
+    result = optimize.optimize_data(table, geometry='geom', verbose=False,
+                                    stage_cache=None)
+    assert isinstance(result, pa.Table)
+    assert result.column_names == ['geom', 'modified']
+    geoms = shapely.from_wkb(result.column('geom').to_numpy(False))
+    assert shapely.equals_exact(geoms, expected.geometry.values, 1e-9).all()
+    assert result.column('modified').to_pylist() == expected.modified.tolist()
+
+
+@pytest.mark.parametrize('name', [
+    'out.geojson', 'out.geojsonl', 'out.fgb',
+    pytest.param('out.parquet', marks=needs_pyarrow)])
+def test_write_and_read_in_batches(tmp_path, name):
+    df = _frame()
+    path = str(tmp_path / name)
+    write_geolocations([df.iloc[:1], df.iloc[1:]], path)
+    back = read_geolocations(path)
+    assert len(back) == 2 and back.crs == df.crs
+    # FlatGeobuf stores the features in the order of its spatial index
+    back = back.sort_values('value')
+    assert back['name'].tolist() == ['a', 'b']
+    assert shapely.equals_exact(back.geometry.values, df.geometry.values,
+                                1e-9).all()
+    batches = list(iter_batches(path, batch_size=1))
+    assert [len(b) for b in batches] == [1, 1]
+    assert [b.index[0] for b in batches] == [0, 1]
@@ -0,0 +1,32 @@
+import json
+
+import geopandas as gpd
+import pytest
+
+from geodata.formats import iter_batches, read_geolocations
+
+LINE = {'type': 'LineString', 'coordinates': [[13.40, 52.50], [13.41, 52.51]]}
+
+
+@pytest.mark.parametrize('data', [
+    {'type': 'Feature', 'properties': {'name': 'a'}, 'geometry': LINE},
+    LINE])
+def test_read_single_feature_or_geometry(tmp_path, data):
+    path = str(tmp_path / 'single.geojson')
+    with open(path, 'w') as fp:
+        json.dump(data, fp)
+    expected = gpd.read_file(path)
+    df = read_geolocations(path)
+    assert len(df) == len(expected) == 1
+    assert df.geometry.geom_equals_exact(expected.geometry, 1e-9).all()
+    assert df.crs == expected.crs
+    batches = list(iter_batches(path, batch_size=10))
+    assert [len(b) for b in batches] == [1]
+
+
+def test_read_other_json_raises(tmp_path):
+    path = str(tmp_path / 'other.geojson')
+    with open(path, 'w') as fp:
+        json.dump({'elements': []}, fp)
+    with pytest.raises(ValueError):
+        read_geolocations(path)
@@ -0,0 +1,37 @@
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString
+
+from graph.ops import list_edges, segment_table, simplify_linestrings
+from osm.convert import load_osm
+
+
+def _edges():
+    return load_osm({'elements': [
+        {'type': 'node', 'id': 1, 'lon': 13.40, 'lat': 52.50},
+        {'type': 'node', 'id': 2, 'lon': 13.41, 'lat': 52.50},
+        {'type': 'way', 'id': 10, 'nodes': [1, 2],
+         'tags': {'highway': 'residential'}}]})
+
+
+def test_list_edges_keeps_locations_at_edge_ends():
+    edges = _edges()
+    e = int(edges['id'].iloc[0])
+    source, target = int(edges['source'].iloc[0]), int(edges['target'].iloc[0])
+    paths = pd.DataFrame({'line': [0, 1, 2], 'edge_id': [e, e, e],
+                          'start': [0., 1., 0.], 'end': [1., 1., 0.],
+                          'reversed': [False, False, False]})
+    df = list_edges(paths, segment_table(edges))
+    nodes = [(n.id, n.location) for n in df['start']] + \
+            [(n.id, n.location) for n in df['end']]
+    assert nodes == [(source, 0), (target, 1), (source, 0),
+                     (target, 1), (target, 1), (source, 0)]
+
+
+def test_simplify_linestrings_drops_collapsed_lines():
+    df = gpd.GeoDataFrame({'line': [0, 1]}, geometry=[
+        LineString([(13.40001, 52.50001), (13.40004, 52.50003)]),
+        LineString([(13.40, 52.50), (13.41, 52.50)])])
+    simplified = simplify_linestrings(df, precision=4)
+    assert list(simplified['line']) == [1]
+    assert simplified.geometry.is_valid.all()
@@ -0,0 +1,33 @@
+import random
+import multiprocessing
+
+import geopandas as gpd
+import shapely
+
+from map_matching.map_matching import PreparedNetwork, build_rtee
+
+_network = None
+
+
+def _query(seed):
+    r, n = random.Random(seed), 0
+    for _ in range(5000):
+        x, y = r.random(), r.random()
+        n += len(list(_network.index.intersection((x, y, x + .01, y + .01))))
+    return n
+
+
+def test_reopen_disk_rtree_in_forked_processes(tmp_path):
+    global _network
+    r = random.Random(0)
+    xy = [(r.random(), r.random()) for _ in range(50000)]
+    df = gpd.GeoDataFrame({'id': range(len(xy)),
+                           'geometry': [shapely.box(x, y, x + .001, y + .001)
+                                        for x, y in xy]})
+    path = str(tmp_path / 'rtree')
+    _network = PreparedNetwork(None, None, None, build_rtee(df, path), path)
+    expected = [_query(seed) for seed in range(8)]
+    with multiprocessing.get_context('fork').Pool(
+            8, initializer=_network.reopen) as pool:
+        # broken reads fail or hang
+        assert pool.map_async(_query, range(8)).get(60) == expected
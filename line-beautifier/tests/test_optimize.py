@@ -0,0 +1,58 @@
+import os
+import json
+
+import geopandas as gpd
+import pytest
+
+import optimize
+from conftest import trace, write_features
+
+
+def test_optimize_many_jobs(overpass, tmp_path):
+    dir_in = tmp_path / 'in'
+    dir_in.mkdir()
+    lines = [trace(0, 1, 4, 1), trace(2, 0, 2, 4), trace(1, 3, 5, 3),
+             trace(4, 0, 4, 5), trace(0, 4, 3, 4), trace(1, 0, 1, 3)]
+    for k in range(3):
+        write_features(str(dir_in / ('in%d.geojson' % k)), lines[2*k:2*k+2])
+    one = optimize.optimize_many(str(dir_in), str(tmp_path / 'one'), jobs=1,
+                                 verbose=False, stage_cache=None)
+    two = optimize.optimize_many(str(dir_in), str(tmp_path / 'two'), jobs=2,
+                                 verbose=False, stage_cache=None)
+    # the network was queried from the disk R-Tree
+    assert any(f.startswith('rtree_network_') for f in os.listdir('.tmp'))
+    assert [os.path.basename(p) for p in one] == \
+           [os.path.basename(p) for p in two]
+    for a, b in zip(one, two):
+        a, b = gpd.read_file(a), gpd.read_file(b)
+        assert len(a) > 0 and a.modified.all()
+        assert a.geometry.geom_equals_exact(b.geometry, 1e-9).all()
+
+
+def test_stage_cache_follows_street_data(overpass, tmp_path):
+    df = gpd.read_file(write_features(str(tmp_path / 'in.geojson'),
+                                      [trace(0, 1, 4, 1), trace(2, 0, 2, 4)]))
+    kwargs = dict(verbose=False, stage_cache=str(tmp_path / 'stages'))
+    optimize.optimize_geolocations(df, **kwargs)
+    # refreshed OSM data numbers the edges differently
+    with open(overpass) as fp:
+        data = json.load(fp)
+    data['elements'].reverse()
+    with open(overpass, 'w') as fp:
+        json.dump(data, fp)
+    cached = optimize.optimize_geolocations(df, **kwargs)
+    expected = optimize.optimize_geolocations(df, verbose=False,
+                                              stage_cache=None)
+    assert len(cached) == len(expected)
+    assert cached.geometry.geom_equals_exact(expected.geometry, 1e-9).all()
+
+
+def test_optimize_many_output_collision(overpass, tmp_path):
+    dir_in = tmp_path / 'in'
+    dir_in.mkdir()
+    write_features(str(dir_in / 'a.geojson'), [trace(0, 1, 4, 1)])
+    write_features(str(dir_in / 'a.json'), [trace(2, 0, 2, 4)])
+    with pytest.raises(ValueError):
+        optimize.optimize_many(str(dir_in), str(tmp_path / 'out'), jobs=1,
+                               verbose=False, stage_cache=None)
+    assert not os.path.exists(str(tmp_path / 'out'))
@@ -0,0 +1,43 @@
+import time
+import tempfile
+
+import pytest
+import shapely
+
+import osm.query_overpass
+from osm.query_overpass import query_bounds, fetch_tiles
+
+BOUNDS = (13.401, 52.501, 13.449, 52.549)
+
+
+def test_query_bounds_covers_whole_tiles_with_a_cache():
+    assert query_bounds(BOUNDS, cache='.tmp', tile_size=.05) == \
+           [(13.4, 52.5, 13.45, 52.55)]
+    assert query_bounds(BOUNDS, cache=None, tile_size=.05) == [BOUNDS]
+
+
+def test_query_bounds_skips_tiles_outside_area():
+    area = shapely.LineString([(13.41, 52.51), (13.49, 52.51)]).buffer(.001)
+    assert query_bounds(area.bounds, cache='.tmp', tile_size=.05) == \
+           [(13.4, 52.5, 13.45, 52.55), (13.45, 52.5, 13.5, 52.55)]
+    assert query_bounds((13.401, 52.501, 13.449, 52.599), cache='.tmp',
+                        tile_size=.05, area=shapely.box(*BOUNDS)) == \
+           [(13.4, 52.5, 13.45, 52.55)]
+
+
+def test_fetch_tiles_closes_running_results_on_error(monkeypatch):
+    files = []
+
+    def fetch(bounds, *args):
+        # the other tiles are running, they cannot be cancelled
+        time.sleep(.1)
+        if bounds == BOUNDS:
+            raise ValueError('rate limited')
+        time.sleep(.2)
+        files.append(tempfile.TemporaryFile())
+        return files[-1]
+    monkeypatch.setattr(osm.query_overpass, '_fetch_tile', fetch)
+    with pytest.raises(ValueError):
+        fetch_tiles([(0, 0, 1, 1), BOUNDS, (1, 1, 2, 2)], workers=3)
+    assert len(files) == 2
+    assert all(fp.closed for fp in files)